@@ -1,108 +1,293 @@
 
+import multiprocessing
 import os
+import select
 import time
 import psycopg2
-import pandas as pd
-from sklearn.ensemble import IsolationForest
-import requests
-from flask import Flask, request, jsonify
-
-DB_HOST = os.environ['DB_HOST']
-DB_NAME = os.environ['DB_NAME']
-DB_USER = os.environ['DB_USER']
-DB_PASSWORD = os.environ['DB_PASSWORD']
+
+from core import metrics
+from core.alert_state import FIRED, AlertPolicy, evaluate
+from core.alerts import AlertDispatcher
+from core.db import Database, PoolTimeout, connect
+from core.schema import READINGS_CHANNEL, check_schema, maintain_partitions
+from psycopg2.extras import execute_values
+
+from detector import STATE_VERSION, StreamingDetector
+from horizon import CommitHorizon
+from partitions import PartitionLeases, partition_of
+
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+ANOMALY_ALPHA = float(os.environ.get('ANOMALY_ALPHA', '0.05'))
+ANOMALY_THRESHOLD = float(os.environ.get('ANOMALY_THRESHOLD', '4'))
+ANOMALY_WARMUP = int(os.environ.get('ANOMALY_WARMUP', '30'))
+RAW_RETENTION_DAYS = int(os.environ.get('RAW_RETENTION_DAYS', '0'))
+ANOMALY_HISTORY = int(os.environ.get('ANOMALY_HISTORY', '200'))
+ANALYZER_BATCH = int(os.environ.get('ANALYZER_BATCH', '1000'))
+ANALYZER_POLL_INTERVAL = float(os.environ.get('ANALYZER_POLL_INTERVAL', '5'))
+ANALYZER_WORKERS = int(os.environ.get('ANALYZER_WORKERS', '1'))
+ANALYZER_PARTITIONS = int(os.environ.get('ANALYZER_PARTITIONS', '16'))
+ANALYZER_REBALANCE_INTERVAL = float(os.environ.get('ANALYZER_REBALANCE_INTERVAL', '10'))
+ANALYZER_METRICS_PORT = int(os.environ.get('ANALYZER_METRICS_PORT', '9100'))
+CHECKPOINT = 'anomaly_detector'
+PARTITION_MAINTENANCE_INTERVAL = 3600
 
-max_retries = 10
-for i in range(max_retries):
-    try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-        break
-    except psycopg2.OperationalError:
-        print("⏳ Ожидаем готовности PostgreSQL...")
-        time.sleep(3)
-else:
-    raise RuntimeError("❌ Не удалось подключиться к PostgreSQL")
-
-conn.autocommit = True
-
-with conn.cursor() as cur:
+BATCH_ROWS = metrics.Histogram("analyzer_batch_rows", "Строк в пачке анализатора",
+                               buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+LAG_ROWS = metrics.Gauge("analyzer_lag_rows", "Последний id показаний минус самый отстающий курсор")
+SCORE_SECONDS = metrics.Histogram("analyzer_score_seconds", "Оценка и обновление детектора на пачку")
+BATCH_SECONDS = metrics.Histogram("analyzer_batch_seconds", "Обработка пачки целиком, с записью состояния")
+FAILURES = metrics.Counter("analyzer_failures_total", "Сбои анализатора", ["stage"])
+
+db = None
+alert_policy = AlertPolicy.from_env()
+
+def checkpoint_name(partition):
+    return f"{CHECKPOINT}:{partition}/{ANALYZER_PARTITIONS}"
+
+def load_checkpoints(partitions):
+    # Курсоры заводятся сразу для всех разделов: с самого отстающего из
+    # прежних (в т.ч. при смене ANALYZER_PARTITIONS), а при первом запуске —
+    # с текущего конца таблицы, а не со всей истории
+    with db.connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO analyzer_checkpoints (name, last_id)
+            SELECT name, COALESCE(
+                (SELECT min(last_id) FROM analyzer_checkpoints WHERE name = %s OR name LIKE %s),
+                (SELECT max(id) FROM sensor_readings),
+                0)
+            FROM unnest(%s::text[]) AS n (name)
+            ON CONFLICT (name) DO NOTHING
+        """, (CHECKPOINT, CHECKPOINT + ':%', [checkpoint_name(p) for p in range(ANALYZER_PARTITIONS)]))
+        cur.execute("SELECT name, last_id FROM analyzer_checkpoints WHERE name = ANY(%s)",
+                    ([checkpoint_name(p) for p in partitions],))
+        last_ids = dict(cur.fetchall())
+    return {p: last_ids[checkpoint_name(p)] for p in partitions}
+
+def load_states(detector, partitions):
+    with db.connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT telegram_id, sensor, parameter, n, mean, var FROM detector_state
+            WHERE version = %s AND abs(telegram_id) %% %s = ANY(%s)
+        """, (STATE_VERSION, ANALYZER_PARTITIONS, list(partitions)))
+        detector.load(((tg_id, s, p), n, mean, var) for tg_id, s, p, n, mean, var in cur)
+
+def save_states(cur, detector):
+    rows = [(*key, STATE_VERSION, n, mean, var) for key, n, mean, var in detector.dump_dirty()]
+    if rows:
+        execute_values(cur, """
+            INSERT INTO detector_state (telegram_id, sensor, parameter, version, n, mean, var) VALUES %s
+            ON CONFLICT (telegram_id, sensor, parameter) DO UPDATE
+            SET version = EXCLUDED.version, n = EXCLUDED.n, mean = EXCLUDED.mean, var = EXCLUDED.var,
+                updated_at = NOW()
+        """, rows)
+
+def warm_new_series(cur, detector, rows):
+    # Ряды без сохранённого состояния прогреваются по последним ANOMALY_HISTORY
+    # показаниям до начала пачки, чтобы не пропускать аномалии на прогреве
+    keys = {(tg_id, s, p) for _, tg_id, _, s, p, _ in rows} - detector.series.keys()
+    if not keys:
+        return
+    tg_ids, sensors, params = zip(*keys)
     cur.execute("""
-        CREATE TABLE IF NOT EXISTS sensor_data_ext (
-            id SERIAL PRIMARY KEY,
-            telegram_id BIGINT,
-            timestamp TIMESTAMP,
-            sensor TEXT,
-            parameter TEXT,
-            value DOUBLE PRECISION,
-            unit TEXT
-        );
-    """)
-
-app = Flask(__name__)
-
-@app.route('/api/v1/data/<int:telegram_id>', methods=['POST'])
-def receive_bulk_data(telegram_id):
-    data = request.json
-    if not isinstance(data, list):
-        data = [data]
-    records = []
-    for record in data:
-        timestamp = record.get("timestamp")
-        for sensor, content in record.items():
-            if sensor == "timestamp":
-                continue
-            records.extend(flatten_data(telegram_id, timestamp, sensor, content))
-
-    with conn.cursor() as cur:
-        for row in records:
-            cur.execute(
-                "INSERT INTO sensor_data_ext (telegram_id, timestamp, sensor, parameter, value, unit) VALUES (%s, %s, %s, %s, %s, %s)",
-                row
-            )
-    return jsonify({"inserted": len(records)}), 201
-
-def flatten_data(telegram_id, timestamp, sensor, nested, path=""):
-    result = []
-    for key, val in nested.items():
-        full_path = f"{path}.{key}" if path else key
-        if isinstance(val, dict) and "value" in val and "unit" in val:
-            result.append((telegram_id, timestamp, sensor, full_path, val["value"], val["unit"]))
-        elif isinstance(val, dict):
-            result.extend(flatten_data(telegram_id, timestamp, sensor, val, full_path))
-    return result
-
-model = IsolationForest(contamination=0.05, random_state=42)
-last_id = 0
-
-while True:
-    with conn.cursor() as cur:
-        cur.execute("SELECT id, telegram_id, timestamp, sensor, parameter, value FROM sensor_data_ext WHERE id > %s ORDER BY id", (last_id,))
-        rows = cur.fetchall()
-    if not rows:
-        time.sleep(5)
-        continue
-    df = pd.DataFrame(rows, columns=["id", "telegram_id", "timestamp", "sensor", "parameter", "value"])
-    last_id = df["id"].max()
-    X = df[["value"]].values
-    if len(X) > 5:
-        preds = model.fit_predict(X)
-        for i, pred in enumerate(preds):
-            if pred == -1:
-                row = df.iloc[i]
+        SELECT k.telegram_id, k.sensor, k.parameter, h.value
+        FROM unnest(%s::bigint[], %s::text[], %s::text[]) AS k (telegram_id, sensor, parameter)
+        JOIN sensor_series s USING (telegram_id, sensor, parameter)
+        CROSS JOIN LATERAL (
+            SELECT r.timestamp, r.id, r.value FROM sensor_readings r
+            WHERE r.series_id = s.id AND r.id < %s AND r.value IS NOT NULL
+            ORDER BY r.timestamp DESC NULLS LAST, r.id DESC
+            LIMIT %s
+        ) h
+        ORDER BY h.timestamp NULLS FIRST, h.id
+    """, (list(tg_ids), list(sensors), list(params), rows[0][0], ANOMALY_HISTORY))
+    history = {key: [] for key in keys}
+    for tg_id, s, p, value in cur:
+        history[(tg_id, s, p)].append(value)
+    for key, values in history.items():
+        detector.warm(key, values)
+
+def process_new(cursors, detector, alerts_dispatcher, horizon):
+    # Разбирает накопившееся по своим разделам пачками по ANALYZER_BATCH.
+    # Одно чтение от самого отстающего курсора; полная пачка покрывает все
+    # строки своих разделов до её последнего id, неполная (и пустая) — до
+    # horizon.safe_id, поэтому после неё все курсоры подтягиваются к этому id
+    # и сохраняются в той же транзакции. Читается только до horizon.safe_id:
+    # выше могут быть id незафиксированных записей.
+    while cursors:
+        started = time.perf_counter()
+        with db.connection() as conn, conn.cursor() as cur:
+            # newest — последнее выданное значение последовательности, дешёвая оценка конца таблицы
+            newest = horizon.advance(cur)
+            cur.execute("""
+                SELECT id, telegram_id, timestamp, sensor, parameter, value FROM sensor_data_ext
+                WHERE id > %s AND id <= %s AND abs(telegram_id) %% %s = ANY(%s)
+                ORDER BY id LIMIT %s
+            """, (min(cursors.values()), horizon.safe_id, ANALYZER_PARTITIONS, list(cursors), ANALYZER_BATCH))
+            rows = cur.fetchall()
+            last_id = rows[-1][0] if len(rows) == ANALYZER_BATCH else horizon.safe_id
+            if not rows and all(c >= last_id for c in cursors.values()):
+                LAG_ROWS.set(max(newest - min(cursors.values()), 0))
+                return
+            events = []
+            if rows:
+                BATCH_ROWS.observe(len(rows))
+                warm_new_series(cur, detector, rows)
+                # Решающие наблюдения рядов: |z| выше порога — нарушение, ниже
+                # порога, уменьшенного на гистерезис, — норма
+                observations = {}
+                clear_below = detector.threshold * (1 - alert_policy.hysteresis)
+                with SCORE_SECONDS.time():
+                    for row_id, telegram_id, timestamp, sensor, parameter, value in rows:
+                        if value is None or row_id <= cursors[partition_of(telegram_id, ANALYZER_PARTITIONS)]:
+                            continue
+                        key = (telegram_id, sensor, parameter)
+                        z = detector.score(key, value)
+                        detector.update(key, value)
+                        if z is not None and (abs(z) > detector.threshold or abs(z) <= clear_below):
+                            observations.setdefault(key, []).append(
+                                (timestamp, abs(z) > detector.threshold, value, timestamp))
+                events = evaluate(cur, 'anomaly', observations, alert_policy)
+                # Состояние детектора фиксируется вместе с курсорами
+                save_states(cur, detector)
+            for p in cursors:
+                cursors[p] = max(cursors[p], last_id)
+            cur.execute("""
+                UPDATE analyzer_checkpoints c SET last_id = v.last_id, updated_at = NOW()
+                FROM unnest(%s::text[], %s::bigint[]) AS v (name, last_id)
+                WHERE c.name = v.name
+            """, ([checkpoint_name(p) for p in cursors], list(cursors.values())))
+        BATCH_SECONDS.observe(time.perf_counter() - started)
+        LAG_ROWS.set(max(newest - min(cursors.values()), 0))
+        # Сообщения — только о переходах состояния и только после фиксации
+        for (telegram_id, sensor, parameter), event, value, timestamp in events:
+            if event == FIRED:
                 message = f"""🚨 Аномалия!
-            Сенсор: {row['sensor']}.{row['parameter']}
-            Значение: {row['value']}
-            Время: {row['timestamp']}
-            """
-                requests.post(f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
-                              data={"chat_id": row['telegram_id'], "text": message})
-    time.sleep(5)
+                Сенсор: {sensor}.{parameter}
+                Значение: {value}
+                Время: {timestamp}
+                """
+            else:
+                message = f"""✅ Норма восстановлена
+                Сенсор: {sensor}.{parameter}
+                Значение: {value}
+                Время: {timestamp}
+                """
+            alerts_dispatcher.send(telegram_id, message)
+        if len(rows) < ANALYZER_BATCH:
+            return
+
+def open_session():
+    # Сессия для LISTEN и advisory-блокировок разделов
+    session = connect(retries=1, **db.params)
+    session.autocommit = True
+    with session.cursor() as cur:
+        cur.execute(f"LISTEN {READINGS_CHANNEL}")
+    return session
+
+def wait_for_readings(session, timeout):
+    # Ждёт NOTIFY от триггера на sensor_readings не дольше timeout
+    if select.select([session], [], [], timeout) != ([], [], []):
+        session.poll()
+        session.notifies.clear()
+
+def run_worker(index=0):
+    """Обработчик разделов telegram_id.
+
+    Несколько процессов (ANALYZER_WORKERS в одном контейнере или несколько
+    контейнеров) делят ANALYZER_PARTITIONS разделов через PartitionLeases;
+    у каждого раздела свой курсор в analyzer_checkpoints, состояние
+    детектора — только по рядам своих разделов (загружается из
+    detector_state при захвате раздела). Пока сессия недоступна,
+    обработчик не владеет разделами и ничего не разбирает. Метрики
+    обработчик отдаёт на ANALYZER_METRICS_PORT + index.
+    """
+    global db
+    metrics.serve(ANALYZER_METRICS_PORT + index)
+    db = Database(maxconn=2)
+    alerts_dispatcher = AlertDispatcher(BOT_TOKEN, api_url=TELEGRAM_API_URL, parse_mode=None)
+    detector = StreamingDetector(alpha=ANOMALY_ALPHA, threshold=ANOMALY_THRESHOLD, warmup=ANOMALY_WARMUP)
+    leases = PartitionLeases(ANALYZER_PARTITIONS)
+    horizon = CommitHorizon()
+    cursors = {}
+    session = None
+    rebalanced = partitions_checked = time.monotonic()
+
+    while True:
+        try:
+            if session is None:
+                session = open_session()
+                leases.attach(session)
+                rebalanced = 0
+            if time.monotonic() - rebalanced > ANALYZER_REBALANCE_INTERVAL:
+                acquired, released = leases.rebalance()
+                rebalanced = time.monotonic()
+                if released:
+                    for p in released:
+                        cursors.pop(p, None)
+                    detector.forget(lambda key: partition_of(key[0], ANALYZER_PARTITIONS) not in released)
+                if acquired:
+                    cursors.update(load_checkpoints(acquired))
+                    load_states(detector, acquired)
+                    print(f"Анализатор {os.getpid()}: разделы {sorted(leases.owned)}")
+        except (psycopg2.Error, RuntimeError) as e:
+            FAILURES.labels("session").inc()
+            print("Analyzer session failed:", e)
+            if session is not None:
+                session.close()
+            session = None
+            leases.lost()
+            cursors.clear()
+            detector.forget(lambda key: False)
+            time.sleep(ANALYZER_POLL_INTERVAL)
+            continue
+
+        try:
+            # Обслуживание секций — на владельце раздела 0, чтобы не делать его N раз
+            if 0 in leases.owned and time.monotonic() - partitions_checked > PARTITION_MAINTENANCE_INTERVAL:
+                with db.connection() as conn:
+                    maintain_partitions(conn, retention_days=RAW_RETENTION_DAYS)
+                partitions_checked = time.monotonic()
+
+            process_new(cursors, detector, alerts_dispatcher, horizon)
+        except (psycopg2.Error, PoolTimeout) as e:
+            FAILURES.labels("batch").inc()
+            print("Analyzer batch failed, will retry:", e)
+            time.sleep(ANALYZER_POLL_INTERVAL)
+            continue
+
+        try:
+            wait_for_readings(session, min(ANALYZER_POLL_INTERVAL, ANALYZER_REBALANCE_INTERVAL))
+        except psycopg2.Error as e:
+            FAILURES.labels("session").inc()
+            print("Analyzer session failed:", e)
+            session.close()
+            session = None
+
+
+def main():
+    # Схему создаёт отдельный шаг (python -m core.schema); здесь только проверка
+    conn = connect()
+    try:
+        check_schema(conn)
+    finally:
+        conn.close()
+
+    if ANALYZER_WORKERS <= 1:
+        run_worker()
+    else:
+        workers = [multiprocessing.Process(target=run_worker, args=(i,), daemon=True) for i in range(ANALYZER_WORKERS)]
+        for worker in workers:
+            worker.start()
+        # Упавший обработчик перезапускается, его разделы тем временем разбирают остальные
+        while True:
+            for i, worker in enumerate(workers):
+                worker.join(timeout=1)
+                if not worker.is_alive():
+                    print(f"Обработчик {worker.pid} завершился с кодом {worker.exitcode}, перезапуск")
+                    workers[i] = multiprocessing.Process(target=run_worker, args=(i,), daemon=True)
+                    workers[i].start()
+
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
+    main()
@@ -0,0 +1,83 @@
+import math
+
+# Меняется, когда меняется смысл сохранённого состояния; чужие версии не загружаются
+STATE_VERSION = 1
+
+
+class SeriesState:
+    __slots__ = ("n", "mean", "var")
+
+    def __init__(self, n=0, mean=0.0, var=0.0):
+        self.n = n
+        self.mean = mean
+        self.var = var
+
+
+class StreamingDetector:
+    """Потоковый детектор аномалий по рядам (telegram_id, sensor, parameter).
+
+    Для каждого ряда хранится только экспоненциально сглаженные среднее и
+    дисперсия, так что новая точка оценивается за O(1) и сравнивается
+    только со своим рядом. Первые warmup точек лишь накапливают статистику
+    (в это время сглаживание совпадает с обычным средним).
+
+    Состояние рядов сохраняется (dump_dirty) и восстанавливается (load), а
+    ряд без сохранённого состояния прогревается по истории (warm), так что
+    после перезапуска детектор не слепнет на время прогрева.
+    """
+
+    def __init__(self, alpha=0.05, threshold=4.0, warmup=30):
+        self.alpha = alpha
+        self.threshold = threshold
+        self.warmup = warmup
+        self.series = {}
+        self.dirty = set()
+
+    def score(self, key, value):
+        # z-оценка точки относительно текущего состояния ряда, None пока ряд прогревается
+        state = self.series.get(key)
+        if state is None or state.n < self.warmup:
+            return None
+        std = max(math.sqrt(state.var), 1e-6 * max(1.0, abs(state.mean)))
+        return (value - state.mean) / std
+
+    def update(self, key, value):
+        # Возвращает z-оценку, если точка аномальна, иначе None
+        state = self.series.get(key)
+        if state is None:
+            state = self.series[key] = SeriesState()
+        z = self.score(key, value)
+        anomalous = z is not None and abs(z) > self.threshold
+        if anomalous:
+            # Выброс учитывается обрезанным, чтобы не раздувать дисперсию
+            value = state.mean + math.copysign(self.threshold * math.sqrt(state.var), z)
+        alpha = max(self.alpha, 1.0 / (state.n + 1))
+        diff = value - state.mean
+        incr = alpha * diff
+        state.mean += incr
+        state.var = (1 - alpha) * (state.var + diff * incr)
+        state.n += 1
+        self.dirty.add(key)
+        return z if anomalous else None
+
+    def warm(self, key, values):
+        # Прогрев по истории ряда (по возрастанию времени), без предупреждений
+        self.series.setdefault(key, SeriesState())
+        for value in values:
+            self.update(key, value)
+
+    def load(self, rows):
+        # rows: (key, n, mean, var)
+        for key, n, mean, var in rows:
+            self.series[key] = SeriesState(n, mean, var)
+
+    def dump_dirty(self):
+        # (key, n, mean, var) рядов, изменившихся с прошлого вызова
+        rows = [(key, s.n, s.mean, s.var) for key in self.dirty if (s := self.series.get(key)) is not None]
+        self.dirty = set()
+        return rows
+
+    def forget(self, keep):
+        # Оставляет состояние только рядов, для которых keep(key) истинно
+        self.series = {key: state for key, state in self.series.items() if keep(key)}
+        self.dirty = {key for key in self.dirty if keep(key)}
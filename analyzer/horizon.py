@@ -0,0 +1,35 @@
+from collections import deque
+
+
+class CommitHorizon:
+    """Граница id показаний, ниже которой новых строк уже не появится.
+
+    id берутся из последовательности при вставке, а транзакции фиксируются в
+    другом порядке: строка с меньшим id может стать видна позже строки с
+    большим. advance() запоминает пару (last_value последовательности, xmax
+    снимка, взятого после него) и объявляет last_value безопасным, когда
+    xmin более позднего снимка дошёл до этого xmax, — то есть завершились
+    все транзакции, которые могли держать id не больше него. Для этого
+    запись показаний получает xid до первого nextval (см.
+    core.storage.insert_readings). Пока идёт долгая пишущая транзакция,
+    граница стоит; из очереди при переполнении выпадают старые пары, что
+    только откладывает продвижение.
+    """
+
+    def __init__(self, size=1000):
+        self.safe_id = 0
+        self._pending = deque(maxlen=size)
+
+    def advance(self, cur):
+        # Возвращает last_value последовательности (для оценки отставания)
+        cur.execute("SELECT last_value FROM sensor_readings_id_seq")
+        newest = cur.fetchone()[0]
+        cur.execute("""
+            SELECT pg_snapshot_xmin(s)::text::bigint, pg_snapshot_xmax(s)::text::bigint
+            FROM pg_current_snapshot() s
+        """)
+        xmin, xmax = cur.fetchone()
+        self._pending.append((xmax, newest))
+        while self._pending and self._pending[0][0] <= xmin:
+            self.safe_id = max(self.safe_id, self._pending.popleft()[1])
+        return newest
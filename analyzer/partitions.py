@@ -0,0 +1,68 @@
+import math
+import random
+
+WORKER_LOCK_CLASS = 7_202_502
+PARTITION_LOCK_CLASS = 7_202_503
+
+
+def partition_of(telegram_id, partitions):
+    # Совпадает с abs(telegram_id) % partitions в SQL (у групп id отрицательные)
+    return abs(telegram_id) % partitions
+
+
+class PartitionLeases:
+    """Разделы abs(telegram_id) % partitions, которыми владеет этот процесс.
+
+    Владение разделом — сессионная advisory-блокировка
+    (PARTITION_LOCK_CLASS, раздел) на соединении session, присутствие
+    процесса — блокировка (WORKER_LOCK_CLASS, pid бэкенда). rebalance()
+    считает живых обработчиков по pg_locks и доводит число своих разделов
+    до справедливой доли: лишние отпускает, недостающие захватывает из
+    свободных. Умерший процесс теряет сессию, его разделы освобождаются и
+    расходятся по остальным при их следующей балансировке.
+    """
+
+    def __init__(self, partitions):
+        self.partitions = partitions
+        self.owned = set()
+        self._session = None
+
+    def attach(self, session):
+        # Новая сессия: прежние блокировки пропали вместе со старой
+        self._session = session
+        self.owned = set()
+        with session.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s, pg_backend_pid())", (WORKER_LOCK_CLASS,))
+
+    def rebalance(self):
+        # Возвращает (захваченные, отпущенные) разделы
+        with self._session.cursor() as cur:
+            cur.execute("""
+                SELECT count(*) FROM pg_locks
+                WHERE locktype = 'advisory' AND classid = %s AND objsubid = 2 AND granted
+            """, (WORKER_LOCK_CLASS,))
+            workers = max(cur.fetchone()[0], 1)
+            share = math.ceil(self.partitions / workers)
+
+            released = set()
+            for p in sorted(self.owned, reverse=True)[:max(len(self.owned) - share, 0)]:
+                cur.execute("SELECT pg_advisory_unlock(%s, %s)", (PARTITION_LOCK_CLASS, p))
+                released.add(p)
+            self.owned -= released
+
+            acquired = set()
+            free = [p for p in range(self.partitions) if p not in self.owned and p not in released]
+            random.shuffle(free)
+            for p in free:
+                if len(self.owned) >= share:
+                    break
+                cur.execute("SELECT pg_try_advisory_lock(%s, %s)", (PARTITION_LOCK_CLASS, p))
+                if cur.fetchone()[0]:
+                    self.owned.add(p)
+                    acquired.add(p)
+        return acquired, released
+
+    def lost(self):
+        self._session = None
+        released, self.owned = self.owned, set()
+        return released
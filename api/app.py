@@ -1,50 +1,207 @@
-from flask import Flask, request, jsonify
-import psycopg2
+from flask import Flask, Response, request, jsonify, make_response
+from datetime import datetime, timedelta, timezone
+import hashlib
+import hmac
+import math
 import os
-import requests
+import threading
+import zlib
+
+import numpy as np
+
+from core import metrics, rollups
+from core.alert_state import FIRED, AlertPolicy, evaluate
+from core.alerts import AlertDispatcher
+from core.db import Database, PoolTimeout
+from core.export import FORMATS as EXPORT_FORMATS, open_export
+from core.flatten import flatten_records, parse_timestamp
+from core.schema import check_schema
+from core.storage import SeriesCatalog, insert_readings
+from idempotency import KeyReused, RecentBatches
+from ingest_log import Flusher, LogFull, SegmentLog
+from packed import CONTENT_TYPES as PACKED_CONTENT_TYPES, decode_batch
+from stream import LineTooLong, batched, iter_ndjson
+from thresholds import ThresholdCache, decisive_readings
 
 app = Flask(__name__)
 
-DB_HOST = os.environ['DB_HOST']
-DB_NAME = os.environ['DB_NAME']
-DB_USER = os.environ['DB_USER']
-DB_PASSWORD = os.environ['DB_PASSWORD']
 BOT_TOKEN = os.environ['BOT_TOKEN']
+INGEST_MAX_BATCH = int(os.environ.get('INGEST_MAX_BATCH', '5000'))
+THRESHOLD_CACHE_TTL = float(os.environ.get('THRESHOLD_CACHE_TTL', '60'))
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+ALERT_QUEUE_SIZE = int(os.environ.get('ALERT_QUEUE_SIZE', '1000'))
+STREAM_BATCH_RECORDS = int(os.environ.get('STREAM_BATCH_RECORDS', '1000'))
+INGEST_WRITE_BEHIND = os.environ.get('INGEST_WRITE_BEHIND', '0') == '1'
+INGEST_LOG_DIR = os.environ.get('INGEST_LOG_DIR', '/var/lib/sensors/ingest')
+INGEST_SEGMENT_MB = float(os.environ.get('INGEST_SEGMENT_MB', '8'))
+INGEST_LOG_QUOTA_MB = float(os.environ.get('INGEST_LOG_QUOTA_MB', '512'))
+INGEST_FLUSH_INTERVAL = float(os.environ.get('INGEST_FLUSH_INTERVAL', '1'))
+EXPORT_TOKEN = os.environ.get('EXPORT_TOKEN', '')
+EXPORT_CONCURRENCY = int(os.environ.get('EXPORT_CONCURRENCY', '2'))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '10000'))
+IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', '86400'))
+SERIES_MAX_BUCKETS = int(os.environ.get('SERIES_MAX_BUCKETS', '5000'))
+SERIES_DEFAULT_BUCKETS = 500
+SERIES_AGGREGATES = ("min", "max", "avg", "count")
+SEGMENT_RETENTION_DAYS = 7
+
+INGEST_ROWS = metrics.Counter("ingest_rows_total", "Принятые показания", ["format"])
+INGEST_PARSE_SECONDS = metrics.Histogram("ingest_parse_seconds", "Разбор тела запроса в столбцы", ["format"])
+INGEST_DB_WRITE_SECONDS = metrics.Histogram("ingest_db_write_seconds", "Запись показаний в БД", ["path"])
+THRESHOLD_LOOKUP_SECONDS = metrics.Histogram("threshold_lookup_seconds", "Поиск порогов и классификация пачки")
+
+# Подключения и фоновые потоки создаёт start(): при импорте модуль ничего
+# не делает, схему заранее готовит python -m core.schema
+db = None
+catalog = None
+thresholds = None
+alerts_dispatcher = None
+ingest_log = None
+_started = False
+_start_lock = threading.Lock()
+
+alert_policy = AlertPolicy.from_env()
+recent_batches = RecentBatches(size=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL)
+# Выгрузка держит соединение из пула всё время передачи
+export_slots = threading.BoundedSemaphore(EXPORT_CONCURRENCY)
+
+def write_segment(name, rows):
+    # Повторно сброшенный после падения сегмент узнаётся по имени в ingest_segments
+    catalog.resolve(rows)
+    with db.connection() as conn:
+        thresholds.refresh_if_stale(conn)
+        with conn.cursor() as cur:
+            cur.execute("INSERT INTO ingest_segments (name) VALUES (%s) ON CONFLICT DO NOTHING", (name,))
+            if not cur.rowcount:
+                return
+            cur.execute("DELETE FROM ingest_segments WHERE flushed_at < NOW() - make_interval(days => %s)",
+                        (SEGMENT_RETENTION_DAYS,))
+        with INGEST_DB_WRITE_SECONDS.labels("flush").time():
+            inserted = insert_readings(conn, catalog, rows, page_size=INGEST_MAX_BATCH)
+        with conn.cursor() as cur:
+            events = row_alerts(cur, rows, inserted)
+    send_alerts(events)
+
+def start():
+    # Однократно: пул, проверка схемы, кэши и фоновые потоки
+    global db, catalog, thresholds, alerts_dispatcher, ingest_log, _started
+    with _start_lock:
+        if _started:
+            return
+        db = Database.from_env()
+        with db.connection() as conn:
+            check_schema(conn)
+        catalog = SeriesCatalog(db.connection)
+        thresholds = ThresholdCache(ttl=THRESHOLD_CACHE_TTL)
+        with db.connection() as conn:
+            thresholds.reload(conn)
+        thresholds.listen(db.connect)
+        alerts_dispatcher = AlertDispatcher(BOT_TOKEN, api_url=TELEGRAM_API_URL, queue_size=ALERT_QUEUE_SIZE)
+        if INGEST_WRITE_BEHIND:
+            ingest_log = SegmentLog(
+                INGEST_LOG_DIR,
+                segment_bytes=int(INGEST_SEGMENT_MB * (1 << 20)),
+                quota_bytes=int(INGEST_LOG_QUOTA_MB * (1 << 20)),
+                max_age=INGEST_FLUSH_INTERVAL,
+            )
+            Flusher(ingest_log, write_segment, interval=INGEST_FLUSH_INTERVAL)
+        _started = True
 
-conn = psycopg2.connect(
-    host=DB_HOST,
-    database=DB_NAME,
-    user=DB_USER,
-    password=DB_PASSWORD
-)
-conn.autocommit = True
-
-# Создание таблиц
-with conn.cursor() as cur:
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS sensor_data_ext (
-            id SERIAL PRIMARY KEY,
-            telegram_id BIGINT,
-            timestamp TIMESTAMP,
-            sensor TEXT,
-            parameter TEXT,
-            value DOUBLE PRECISION,
-            unit TEXT
-        );
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS alert_thresholds (
-            id SERIAL PRIMARY KEY,
-            telegram_id BIGINT,
-            sensor TEXT,
-            parameter TEXT,
-            lower DOUBLE PRECISION,
-            upper DOUBLE PRECISION
-        );
-    """)
+@app.before_request
+def ensure_started():
+    # Под WSGI-сервером, импортирующим app, старт происходит на первом запросе
+    if not _started and request.endpoint != 'metrics_endpoint':
+        start()
+
+def batch_alerts(cur, batch, telegram_id, inserted):
+    # Сообщения шлются только при переходах состояния ряда (см. core.alert_state).
+    # Учитываются только вставленные показания (inserted — ключи (series_id,
+    # timestamp) из insert_readings): повтор уже сохранённой пачки автомат не двигает
+    fresh = set(inserted)
+    with THRESHOLD_LOOKUP_SECONDS.time():
+        lower, upper = batch.bounds(lambda s, p: thresholds.get(telegram_id, s, p))
+        idx, breach = decisive_readings(batch.values, lower, upper, alert_policy.hysteresis)
+        observations = {}
+        for i, b in zip(idx.tolist(), breach.tolist()):
+            key = (telegram_id, batch.sensor(i), batch.parameter(i))
+            if not _take(fresh, key, batch.timestamps[i]):
+                continue
+            observations.setdefault(key, []).append(
+                (batch.timestamps[i], b, batch.values[i].item(), (lower[i].item(), upper[i].item())))
+    return evaluate(cur, 'threshold', observations, alert_policy)
+
+def row_alerts(cur, rows, inserted):
+    # То же для строк (telegram_id, timestamp, sensor, parameter, value, unit) из
+    # журнала; время в них — строка ISO 8601
+    fresh = set(inserted)
+    with THRESHOLD_LOOKUP_SECONDS.time():
+        keys = {}
+        codes = np.array([keys.setdefault((r[0], r[2], r[3]), len(keys)) for r in rows], dtype=np.int64)
+        values = np.array([np.nan if r[4] is None else r[4] for r in rows], dtype=np.float64)
+        bounds = np.array([
+            [np.nan if b is None else b for b in (thresholds.get(*key) or (None, None))] for key in keys
+        ], dtype=np.float64).reshape(-1, 2)
+        lower, upper = bounds[codes, 0], bounds[codes, 1]
+        idx, breach = decisive_readings(values, lower, upper, alert_policy.hysteresis)
+        key_list = list(keys)
+        observations = {}
+        for i, b in zip(idx.tolist(), breach.tolist()):
+            key, timestamp = key_list[codes[i]], parse_timestamp(rows[i][1])
+            if not _take(fresh, key, timestamp):
+                continue
+            observations.setdefault(key, []).append(
+                (timestamp, b, values[i].item(), (lower[i].item(), upper[i].item())))
+    return evaluate(cur, 'threshold', observations, alert_policy)
+
+def _take(fresh, key, timestamp):
+    # Показание вставлено этой записью; повтор ключа внутри пачки в БД не попал
+    stored = (catalog.series_id(*key), timestamp)
+    if stored not in fresh:
+        return False
+    fresh.discard(stored)
+    return True
+
+def send_alerts(events):
+    # Отправка предупреждений (в фоне, не задерживает ответ)
+    for (tg_id, s, p), event, val, (low, high) in events:
+        if event == FIRED:
+            msg = f"⚠️ <b>Аномалия!</b>\nДатчик: <b>{s}</b>\nПараметр: <b>{p}</b>\nЗначение: <b>{val}</b> вне диапазона [{low} - {high}]"
+        else:
+            msg = f"✅ <b>Норма восстановлена</b>\nДатчик: <b>{s}</b>\nПараметр: <b>{p}</b>\nЗначение: <b>{val}</b>"
+        alerts_dispatcher.send(tg_id, msg)
 
 @app.route('/api/v1/data', methods=['POST'])
 def receive_bulk_data():
+    # Повтор пачки с тем же Idempotency-Key отвечается из recent_batches, не
+    # доходя до БД; без ключа повторы отсекает уникальный индекс показаний
+    key = request.headers.get("Idempotency-Key")
+    if key is None:
+        return ingest_batch()
+    if len(key) > 255:
+        return jsonify({"error": "Idempotency-Key too long"}), 400
+    digest = recent_batches.digest(request.get_data())
+    try:
+        replay = recent_batches.get(key, digest)
+    except KeyReused:
+        return jsonify({"error": "Idempotency-Key reused with a different body"}), 422
+    if replay is not None:
+        body, status = replay
+        return jsonify(body), status, {"Idempotent-Replayed": "true"}
+
+    response = make_response(ingest_batch())
+    if response.status_code in (201, 202):
+        recent_batches.put(key, digest, (response.get_json(), response.status_code))
+    return response
+
+def ingest_batch():
+    if request.mimetype in PACKED_CONTENT_TYPES:
+        try:
+            with INGEST_PARSE_SECONDS.labels("packed").time():
+                telegram_id, batch = decode_batch(request.get_data())
+        except (KeyError, TypeError, ValueError):
+            return jsonify({"error": "Invalid data"}), 400
+        return store_response(batch, telegram_id, "packed")
+
     payload = request.json
 
     telegram_id = payload.get("telegram_id")
@@ -52,71 +209,266 @@ def receive_bulk_data():
 
     if not telegram_id or not isinstance(measurements, list):
         return jsonify({"error": "Missing telegram_id or invalid data"}), 400
+    try:
+        telegram_id = int(telegram_id)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid telegram_id"}), 400
 
-    records = []
-    alerts = []
+    try:
+        with INGEST_PARSE_SECONDS.labels("json").time():
+            batch = flatten_records(measurements)
+    except (AttributeError, TypeError, ValueError):
+        return jsonify({"error": "Invalid data"}), 400
 
-    for record in measurements:
-        timestamp = record.get("timestamp")
-        for sensor, content in record.items():
-            if sensor == "timestamp":
-                continue
-            rows = flatten_data(telegram_id, timestamp, sensor, content)
-            records.extend(rows)
-
-            # Проверка на аномалии
-            for _, ts, s, param, value, _ in rows:
-                with conn.cursor() as cur:
-                    cur.execute("""
-                        SELECT lower, upper FROM alert_thresholds
-                        WHERE telegram_id = %s AND sensor = %s AND parameter = %s
-                    """, (telegram_id, s, param))
-                    threshold = cur.fetchone()
-                    if threshold:
-                        lower, upper = threshold
-                        if value < lower or value > upper:
-                            alerts.append((telegram_id, s, param, value, lower, upper))
-
-    # Вставка данных
-    with conn.cursor() as cur:
-        for row in records:
+    return store_response(batch, telegram_id, "json")
+
+def store_response(batch, telegram_id, fmt):
+    try:
+        count, alerts = store(batch, telegram_id, fmt)
+    except LogFull:
+        return jsonify({"error": "Ingest buffer full"}), 503, {"Retry-After": "5"}
+    except PoolTimeout:
+        return jsonify({"error": "Database busy"}), 503
+
+    if ingest_log is not None:
+        return jsonify({"accepted": count, "alerts": alerts}), 202
+    return jsonify({"inserted": count, "alerts": alerts}), 201
+
+@app.route('/api/v1/data/stream', methods=['POST'])
+def receive_stream():
+    # Тело — NDJSON (запись на строку), можно с Content-Encoding: gzip.
+    # Записи разбираются по мере чтения и сохраняются пачками по
+    # STREAM_BATCH_RECORDS; каждая пачка фиксируется отдельно, поэтому при
+    # ошибке в середине ответ сообщает, сколько строк уже сохранено.
+    try:
+        telegram_id = int(request.args.get("telegram_id") or request.headers.get("X-Telegram-Id"))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Missing telegram_id or invalid data"}), 400
+    encoding = request.headers.get("Content-Encoding", "identity").lower()
+    if encoding not in ("identity", "gzip"):
+        return jsonify({"error": f"Unsupported Content-Encoding: {encoding}"}), 415
+
+    key = "inserted" if ingest_log is None else "accepted"
+    count = alerts = 0
+    try:
+        records = iter_ndjson(request.stream, gzip=encoding == "gzip")
+        for chunk in batched(records, STREAM_BATCH_RECORDS):
+            with INGEST_PARSE_SECONDS.labels("stream").time():
+                batch = flatten_records(chunk)
+            stored, found = store(batch, telegram_id, "stream")
+            count += stored
+            alerts += found
+    except LineTooLong:
+        return jsonify({"error": "Record too large", key: count}), 413
+    except (AttributeError, TypeError, ValueError, zlib.error):
+        return jsonify({"error": "Invalid data", key: count}), 400
+    except LogFull:
+        return jsonify({"error": "Ingest buffer full", key: count}), 503, {"Retry-After": "5"}
+    except PoolTimeout:
+        return jsonify({"error": "Database busy", key: count}), 503
+
+    return jsonify({key: count, "alerts": alerts}), 201 if ingest_log is None else 202
+
+def store(batch, telegram_id, fmt):
+    # Сохраняет пачку и рассылает предупреждения; возвращает (строк, отправленных
+    # предупреждений). Строк — новых: уже сохранённые показания пропускаются
+    records = batch.rows(telegram_id)
+    INGEST_ROWS.labels(fmt).inc(len(records))
+
+    if ingest_log is not None:
+        # Отложенная запись: строки уже на диске, в БД их сбросит Flusher,
+        # он же проверит пороги и разошлёт предупреждения
+        ingest_log.append(records)
+        return len(records), 0
+
+    catalog.resolve(records)
+    with db.connection() as conn:
+        # Вставка данных
+        with INGEST_DB_WRITE_SECONDS.labels("sync").time():
+            inserted = insert_readings(conn, catalog, records, page_size=INGEST_MAX_BATCH)
+
+        # Проверка порогов
+        thresholds.refresh_if_stale(conn)
+        with conn.cursor() as cur:
+            events = batch_alerts(cur, batch, telegram_id, inserted)
+
+    send_alerts(events)
+    return len(inserted), len(events)
+
+def read_denied():
+    # Чтение показаний (выгрузка, агрегаты) — по EXPORT_TOKEN в
+    # Authorization: Bearer; без токена эти эндпоинты выключены
+    if not EXPORT_TOKEN:
+        return jsonify({"error": "Read API disabled"}), 404
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {EXPORT_TOKEN}"):
+        return jsonify({"error": "Unauthorized"}), 401
+    return None
+
+@app.route('/api/v1/export', methods=['GET'])
+def export_readings():
+    # Показания telegram_id потоком CSV или Parquet: ?telegram_id=&sensor=&parameter=
+    # &start=&end= (ISO 8601, end не включается)&format=csv|parquet
+    denied = read_denied()
+    if denied:
+        return denied
+    args = request.args
+    try:
+        telegram_id = int(args["telegram_id"])
+        start, end = (parse_timestamp(args[k]) if args.get(k) else None for k in ("start", "end"))
+    except (KeyError, ValueError):
+        return jsonify({"error": "Missing telegram_id or invalid range"}), 400
+    fmt = args.get("format", "csv")
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": f"Unsupported format: {fmt}"}), 400
+    mimetype, extension, encode = EXPORT_FORMATS[fmt]
+
+    if not export_slots.acquire(blocking=False):
+        return jsonify({"error": "Too many exports"}), 429, {"Retry-After": "30"}
+    chunks = export_chunks(encode, telegram_id, args.get("sensor"), args.get("parameter"), start, end)
+    try:
+        # Первый кусок — до ответа, чтобы ошибки подключения дали статус, а не обрыв
+        first = next(chunks, b"")
+    except PoolTimeout:
+        return jsonify({"error": "Database busy"}), 503
+    except ImportError:
+        return jsonify({"error": "Parquet export is not available"}), 501
+    response = Response(prefixed(first, chunks), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f'attachment; filename="sensors-{telegram_id}.{extension}"'
+    return response
+
+def export_chunks(encode, telegram_id, sensor, parameter, start, end):
+    try:
+        with db.connection() as conn:
+            yield from encode(open_export(conn, telegram_id, sensor, parameter, start, end))
+    finally:
+        export_slots.release()
+
+def prefixed(first, rest):
+    try:
+        yield first
+        yield from rest
+    finally:
+        rest.close()
+
+@app.route('/api/v1/series/<int(signed=True):telegram_id>', methods=['GET'])
+@app.route('/api/v1/series/<int(signed=True):telegram_id>/<sensor>/<parameter>', methods=['GET'])
+def series_aggregates(telegram_id, sensor=None, parameter=None):
+    # Агрегаты по корзинам, посчитанные в БД: ?from=&to= (ISO 8601, to не
+    # включается; по умолчанию — последние сутки), bucket= (секунды; по
+    # умолчанию ~SERIES_DEFAULT_BUCKETS корзин), agg=min,max,avg,count,p50,p99.
+    # Несколько рядов за раз — series=датчик/параметр (повторяется). Ответ
+    # по столбцам на ряд; ETag меняется с каждой записью показаний, так что
+    # опрос с If-None-Match стоит одного чтения последовательности.
+    denied = read_denied()
+    if denied:
+        return denied
+    args = request.args
+    keys = [(sensor, parameter)] if sensor else [tuple(s.split("/", 1)) for s in args.getlist("series")]
+    try:
+        series_args = validate_series_args(keys, args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    start, end, bucket, aggregates, percentiles = series_args
+
+    try:
+        with db.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT last_value FROM sensor_readings_id_seq")
+            tag = hashlib.sha1(repr((cur.fetchone()[0], telegram_id, keys, series_args)).encode()).hexdigest()[:20]
+            etag = f'W/"{tag}"'
+            if request.if_none_match.contains_weak(tag):
+                return "", 304, {"ETag": etag, "Cache-Control": "no-cache"}
             cur.execute("""
-                INSERT INTO sensor_data_ext (telegram_id, timestamp, sensor, parameter, value, unit)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, row)
-
-    # Отправка предупреждений
-    for tg_id, s, p, val, low, high in alerts:
-        msg = f"⚠️ <b>Аномалия!</b>\nДатчик: <b>{s}</b>\nПараметр: <b>{p}</b>\nЗначение: <b>{val}</b> вне диапазона [{low} - {high}]"
-        send_telegram_alert(tg_id, msg)
-
-    return jsonify({"inserted": len(records), "alerts": len(alerts)}), 201
-
-def flatten_data(telegram_id, timestamp, sensor, nested, path=""):
-    result = []
-    for key, val in nested.items():
-        full_path = f"{path}.{key}" if path else key
-        if isinstance(val, dict) and "value" in val and "unit" in val:
-            result.append((telegram_id, timestamp, sensor, full_path, val["value"], val["unit"]))
-        elif isinstance(val, dict):
-            result.extend(flatten_data(telegram_id, timestamp, sensor, val, full_path))
-    return result
-
-def send_telegram_alert(chat_id, message):
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-    data = {
-        "chat_id": chat_id,
-        "text": message,
-        "parse_mode": "HTML"
-    }
+                SELECT s.id, s.sensor, s.parameter
+                FROM sensor_series s
+                JOIN unnest(%s::text[], %s::text[]) AS k (sensor, parameter) USING (sensor, parameter)
+                WHERE s.telegram_id = %s
+            """, ([k[0] for k in keys], [k[1] for k in keys], telegram_id))
+            ids = {(s, p): series_id for series_id, s, p in cur.fetchall()}
+            source, rows = rollups.aggregate(cur, ids.values(), start, end, bucket, percentiles) if ids else (None, [])
+    except PoolTimeout:
+        return jsonify({"error": "Database busy"}), 503
+
+    quantile_names = [a for a in aggregates if a not in SERIES_AGGREGATES]
+    columns = {series_id: {"t": [], **{a: [] for a in aggregates}} for series_id in ids.values()}
+    for series_id, b, low, high, avg, count, *quantiles in rows:
+        values = {"min": low, "max": high, "avg": avg, "count": count}
+        if quantiles:
+            values.update(zip(quantile_names, quantiles[0]))
+        column = columns[series_id]
+        column["t"].append(b.isoformat())
+        for a in aggregates:
+            column[a].append(values[a])
+    body = jsonify({
+        "telegram_id": telegram_id,
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "bucket": bucket,
+        "source": source,
+        "series": [
+            {"sensor": s, "parameter": p, **columns.get(ids.get((s, p)), {"t": [], **{a: [] for a in aggregates}})}
+            for s, p in keys
+        ],
+    })
+    body.headers["ETag"] = etag
+    body.headers["Cache-Control"] = "no-cache"
+    return body
+
+def validate_series_args(keys, args):
+    # -> (start, end, bucket, агрегаты, перцентили как доли); ValueError — неверный запрос
+    if not keys or any(len(k) != 2 for k in keys):
+        raise ValueError("Specify sensor/parameter")
     try:
-        requests.post(url, json=data, timeout=3)
-    except Exception as e:
-        print("Failed to send alert:", e)
+        # Время со смещением или Z приводится к UTC без пояса, как в sensor_readings
+        end = parse_timestamp(args["to"]) if args.get("to") else None
+        start = parse_timestamp(args["from"]) if args.get("from") else None
+        bucket = int(args["bucket"]) if args.get("bucket") else None
+    except ValueError:
+        raise ValueError("Invalid from, to or bucket")
+    if end is None:
+        # Конец по умолчанию — следующая полная минута, чтобы окно сдвигалось
+        # раз в минуту и подходило под агрегаты sensor_rollups
+        now = datetime.now(timezone.utc).replace(tzinfo=None, second=0, microsecond=0)
+        end = now + timedelta(minutes=1)
+    start = start or end - timedelta(days=1)
+    span = (end - start).total_seconds()
+    if span <= 0:
+        raise ValueError("from must be before to")
+    if bucket is None:
+        bucket = math.ceil(span / SERIES_DEFAULT_BUCKETS)
+        for resolution in rollups.RESOLUTIONS:
+            if bucket > resolution:
+                bucket = math.ceil(bucket / resolution) * resolution
+    if bucket < 1 or span / bucket > SERIES_MAX_BUCKETS:
+        raise ValueError(f"bucket must be at least 1 s and give at most {SERIES_MAX_BUCKETS} buckets")
+
+    aggregates, percentiles = [], []
+    for a in (args.get("agg") or ",".join(SERIES_AGGREGATES)).split(","):
+        if a in SERIES_AGGREGATES:
+            if a not in aggregates:
+                aggregates.append(a)
+            continue
+        try:
+            q = float(a[1:]) if a.startswith("p") else None
+        except ValueError:
+            q = None
+        if q is None or not 0 <= q <= 100:
+            raise ValueError(f"Unknown aggregate: {a}")
+        if f"p{q:g}" not in aggregates:
+            aggregates.append(f"p{q:g}")
+            percentiles.append(q / 100)
+    return start, end, bucket, tuple(aggregates), tuple(percentiles)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.REGISTRY.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
 
 @app.route('/')
 def index():
     return 'Sensor API running!'
 
-if __name__ == '__main__':
+def main():
+    start()
     app.run(host='0.0.0.0', port=5000)
+
+if __name__ == '__main__':
+    main()
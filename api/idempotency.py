@@ -0,0 +1,51 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class KeyReused(Exception):
+    pass
+
+
+class RecentBatches:
+    """Ответы на недавние пачки по заголовку Idempotency-Key.
+
+    Повтор пачки с тем же ключом и тем же телом получает сохранённый ответ
+    без обращения к БД; тот же ключ с другим телом — KeyReused. Хранится не
+    больше size ключей и не дольше ttl секунд. Одновременные повторы, пока
+    первый запрос не завершился, проходят в БД и отсекаются уникальным
+    индексом показаний.
+    """
+
+    def __init__(self, size=10000, ttl=86400):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(body):
+        return hashlib.blake2b(body, digest_size=16).digest()
+
+    def get(self, key, digest):
+        # Сохранённый ответ (тело, статус) или None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, stored_digest, response = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            if stored_digest != digest:
+                raise KeyReused(key)
+            self._entries.move_to_end(key)
+            return response
+
+    def put(self, key, digest, response):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, digest, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
@@ -0,0 +1,266 @@
+import fcntl
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+
+import psycopg2
+
+from core import metrics
+
+SEGMENT_SUFFIX = ".seg"
+LOCK_SUFFIX = ".lock"
+# Кадр: длина и crc32 тела, затем JSON-массив строк
+FRAME_HEADER = struct.Struct(">II")
+
+SEGMENT_FAILURES = metrics.Counter("ingest_segment_failures_total", "Неудачные сбросы сегментов журнала", ["outcome"])
+
+
+class LogFull(Exception):
+    pass
+
+
+class SegmentLog:
+    """Локальный журнал принятых, но ещё не записанных в БД показаний.
+
+    append() дописывает пачку строк кадром в активный сегмент и
+    возвращается после fsync; параллельные вызовы разделяют один fsync.
+    Сегмент закрывается по размеру (segment_bytes) или возрасту (max_age)
+    и становится доступен сбрасывателю. Если журнал занимает больше
+    quota_bytes, append() поднимает LogFull.
+
+    Каталог могут делить несколько процессов API: имя сегмента содержит
+    владельца (хост и pid), владелец держит flock на своём файле .lock.
+    Сегменты процесса, чей замок свободен (процесс завершился), забирает
+    себе тот, кто первым захватил замок; забранные считаются закрытыми,
+    оборванный последний кадр отбрасывается.
+    """
+
+    ADOPT_INTERVAL = 10.0
+
+    def __init__(self, directory, segment_bytes=8 << 20, quota_bytes=512 << 20, max_age=1.0):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.quota_bytes = quota_bytes
+        self.max_age = max_age
+        self.ready = threading.Event()
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._file = None
+        self._opened_at = None
+        self._written = 0
+        self._synced = 0
+        self._owner = f"{socket.gethostname()}-{os.getpid()}"
+        self._sealed = []
+        self._size = 0
+        # Владелец -> дескриптор его захваченного замка (свой — всегда здесь)
+        self._locks = {}
+        self._adopted_at = 0.0
+        # Процесс с тем же pid мог остаться от прошлого запуска: его сегменты
+        # достаются нам, но замок может ненадолго держать забирающий их сосед
+        self._locks[self._owner] = self._lock_owner(self._owner, blocking=True)
+        self._adopt()
+
+    def append(self, rows):
+        frame = _frame(rows)
+        with self._lock:
+            if self._size + len(frame) > self.quota_bytes:
+                raise LogFull(f"ingest log exceeds {self.quota_bytes} bytes")
+            if self._file is None:
+                self._open()
+            self._file.write(frame)
+            self._size += len(frame)
+            self._written += 1
+            seq = self._written
+            if self._file.tell() >= self.segment_bytes:
+                self._seal()
+        self._sync(seq)
+
+    def _sync(self, seq):
+        # Групповой fsync: кто ждал блокировку, скорее всего уже покрыт чужим
+        with self._sync_lock:
+            with self._lock:
+                if self._synced >= seq:
+                    return
+                self._file.flush()
+                fd = os.dup(self._file.fileno())
+                target = self._written
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            with self._lock:
+                self._synced = max(self._synced, target)
+
+    def _lock_owner(self, owner, blocking=False):
+        # Дескриптор с захваченным flock или None, если владелец жив
+        fd = os.open(os.path.join(self.directory, owner + LOCK_SUFFIX), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def _adopt(self):
+        # Под self._lock или до запуска потоков. Свои оставшиеся от прошлого
+        # запуска сегменты и сегменты завершившихся процессов -> в _sealed;
+        # замки владельцев, чьи сегменты все сброшены, отпускаются
+        self._adopted_at = time.monotonic()
+        active = self._file.name if self._file is not None else None
+        by_owner = {}
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(SEGMENT_SUFFIX):
+                path = os.path.join(self.directory, name)
+                if path != active and path not in self._sealed:
+                    by_owner.setdefault(segment_owner(name), []).append(path)
+        for owner, paths in by_owner.items():
+            if owner not in self._locks:
+                fd = self._lock_owner(owner)
+                if fd is None:
+                    continue
+                self._locks[owner] = fd
+            for path in paths:
+                try:
+                    self._size += os.path.getsize(path)
+                except FileNotFoundError:
+                    continue  # успел сбросить прежний держатель замка
+                self._sealed.append(path)
+        self._sealed.sort(key=os.path.basename)
+        pending = {segment_owner(os.path.basename(path)) for path in self._sealed}
+        for owner in [o for o in self._locks if o != self._owner and o not in pending]:
+            os.close(self._locks.pop(owner))
+        if self._sealed:
+            self.ready.set()
+
+    def _open(self):
+        name = f"{time.time_ns():020d}-{self._owner}{SEGMENT_SUFFIX}"
+        self._file = open(os.path.join(self.directory, name), "ab")
+        self._opened_at = time.monotonic()
+
+    def _seal(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._sealed.append(self._file.name)
+        self._synced = self._written
+        self._file = None
+        self.ready.set()
+
+    def sealed(self):
+        # Закрывает активный сегмент, если он старше max_age, и отдаёт готовые к сбросу
+        with self._lock:
+            if self._file is not None and time.monotonic() - self._opened_at >= self.max_age:
+                self._seal()
+            if time.monotonic() - self._adopted_at >= self.ADOPT_INTERVAL:
+                self._adopt()
+            if not self._sealed:
+                self.ready.clear()
+            return list(self._sealed)
+
+    def remove(self, path):
+        self._discard(path, os.remove)
+
+    def quarantine(self, path, frames):
+        # Отвергнутые БД кадры сегмента откладываются в .bad (вне квоты), сам сегмент удаляется
+        with open(path + ".bad", "wb") as f:
+            for rows in frames:
+                f.write(_frame(rows))
+            f.flush()
+            os.fsync(f.fileno())
+        self.remove(path)
+
+    def _discard(self, path, action):
+        size = os.path.getsize(path)
+        action(path)
+        with self._lock:
+            self._sealed.remove(path)
+            self._size -= size
+
+
+def segment_owner(name):
+    # "<время>-<хост>-<pid>.seg" -> "<хост>-<pid>"
+    return name[:-len(SEGMENT_SUFFIX)].split("-", 1)[-1]
+
+
+def _frame(rows):
+    data = json.dumps(rows, separators=(",", ":"), default=datetime.isoformat).encode()
+    return FRAME_HEADER.pack(len(data), zlib.crc32(data)) + data
+
+
+def read_segment(path):
+    # Кадры сегмента (по пачке строк на append) по порядку
+    with open(path, "rb") as f:
+        data = f.read()
+    frames = []
+    pos = 0
+    while pos + FRAME_HEADER.size <= len(data):
+        length, crc = FRAME_HEADER.unpack_from(data, pos)
+        body = data[pos + FRAME_HEADER.size:pos + FRAME_HEADER.size + length]
+        if len(body) < length or zlib.crc32(body) != crc:
+            break
+        frames.append(json.loads(body))
+        pos += FRAME_HEADER.size + length
+    if pos != len(data):
+        print(f"Ingest log {path}: отброшен оборванный хвост {len(data) - pos} байт")
+    return frames
+
+
+class Flusher:
+    """Фоновый сброс закрытых сегментов в БД.
+
+    write(name, rows) должна записать строки одной транзакцией и быть
+    идемпотентной по имени сегмента: сегмент удаляется только после
+    коммита, так что после падения он может быть сброшен повторно.
+    Если БД отвергает сегмент, он сбрасывается по кадру (имя сегмента с
+    номером кадра), и в карантин уходят только отвергнутые кадры.
+    """
+
+    def __init__(self, log, write, interval=1.0, max_backoff=30):
+        self.log = log
+        self.write = write
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        failures = 0
+        while True:
+            if failures:
+                time.sleep(min(self.interval * 2 ** failures, self.max_backoff))
+            else:
+                self.log.ready.wait(self.interval)
+            try:
+                for path in self.log.sealed():
+                    self._flush(path)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                SEGMENT_FAILURES.labels("retry").inc()
+                print("Ingest log flush failed, will retry:", e)
+
+    def _flush(self, path):
+        name = os.path.basename(path)
+        frames = read_segment(path)
+        try:
+            self.write(name, [row for rows in frames for row in rows])
+        except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+            print(f"Ingest log {path} rejected by database, flushing frame by frame:", e)
+            bad = []
+            for i, rows in enumerate(frames):
+                try:
+                    self.write(f"{name}#{i}", rows)
+                except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+                    print(f"Ingest log {path} frame {i} rejected by database, quarantined:", e)
+                    bad.append(rows)
+            if bad:
+                SEGMENT_FAILURES.labels("quarantined").inc(len(bad))
+                self.log.quarantine(path, bad)
+                return
+        self.log.remove(path)
@@ -0,0 +1,65 @@
+import msgpack
+import numpy as np
+
+from core.flatten import FlatBatch, check_units, parse_timestamp
+
+CONTENT_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+
+
+def decode_batch(body):
+    """Пачка показаний в компактном формате MessagePack -> (telegram_id, FlatBatch).
+
+    Словари отправляются один раз на пачку, показания — упакованными столбцами:
+
+        {
+          "telegram_id": 902075408,
+          "series": [["bme280", "env.temperature", "C"], ...],  # датчик, параметр, единица
+          "timestamps": ["2025-06-01T12:00:00", ...],
+          "series_ids": <bin: uint32 LE на строку, индекс в series>,
+          "timestamp_ids": <bin: uint32 LE на строку, индекс в timestamps>,
+          "values": <bin: float64 LE на строку, NaN — нет значения>
+        }
+
+    Столбцы оборачиваются в numpy без копирования. ValueError — пачка не
+    соответствует формату.
+    """
+    payload = msgpack.unpackb(body, raw=False, strict_map_key=True)
+    if not isinstance(payload, dict):
+        raise ValueError("batch must be a map")
+    telegram_id = int(payload["telegram_id"])
+    series = payload["series"]
+    timestamps = [parse_timestamp(ts) for ts in payload["timestamps"]]
+    if not all(isinstance(s, list) and len(s) == 3 and isinstance(s[0], str) and isinstance(s[1], str)
+               for s in series):
+        raise ValueError("series entries must be [sensor, parameter, unit]")
+
+    values = np.frombuffer(payload["values"], dtype="<f8")
+    series_ids = np.frombuffer(payload["series_ids"], dtype="<u4")
+    timestamp_ids = np.frombuffer(payload["timestamp_ids"], dtype="<u4")
+    if not len(values) == len(series_ids) == len(timestamp_ids):
+        raise ValueError("column lengths differ")
+    if len(values) and (series_ids.max() >= len(series) or timestamp_ids.max() >= len(timestamps)):
+        raise ValueError("dictionary index out of range")
+
+    sensors, parameters = {}, {}
+    series_sensor = np.array([sensors.setdefault(s, len(sensors)) for s, _, _ in series], dtype=np.int64)
+    series_parameter = np.array([parameters.setdefault(p, len(parameters)) for _, p, _ in series], dtype=np.int64)
+    check_units([u for _, _, u in series])
+    series_unit = _objects([u for _, _, u in series])
+
+    return telegram_id, FlatBatch(
+        timestamps=_objects(timestamps)[timestamp_ids].tolist(),
+        sensor_ids=series_sensor[series_ids],
+        parameter_ids=series_parameter[series_ids],
+        values=values,
+        units=series_unit[series_ids].tolist(),
+        sensors=list(sensors),
+        parameters=list(parameters),
+    )
+
+
+def _objects(items):
+    # np.array(items, dtype=object) развернул бы вложенные списки в измерения
+    array = np.empty(len(items), dtype=object)
+    array[:] = items
+    return array
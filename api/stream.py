@@ -0,0 +1,50 @@
+import json
+import zlib
+
+CHUNK_SIZE = 64 << 10
+
+
+class LineTooLong(ValueError):
+    pass
+
+
+def iter_ndjson(stream, gzip=False, chunk_size=CHUNK_SIZE, max_line=1 << 20):
+    # Записи NDJSON из файлоподобного потока по мере чтения; в памяти не
+    # больше одного куска и одной незавершённой строки. Пустые строки пропускаются.
+    tail = b""
+    for chunk in _read_chunks(stream, gzip, chunk_size):
+        lines = (tail + chunk).split(b"\n")
+        tail = lines.pop()
+        if len(tail) > max_line:
+            raise LineTooLong(f"record longer than {max_line} bytes")
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if tail.strip():
+        yield json.loads(tail)
+
+
+def _read_chunks(stream, gzip, chunk_size):
+    if not gzip:
+        yield from iter(lambda: stream.read(chunk_size), b"")
+        return
+    # Распакованные куски тоже не больше chunk_size, так что gzip-бомба не раздувает память
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        while chunk:
+            yield decompressor.decompress(chunk, chunk_size)
+            chunk = decompressor.unconsumed_tail
+    yield decompressor.flush()
+    if not decompressor.eof:
+        raise ValueError("truncated gzip stream")
+
+
+def batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
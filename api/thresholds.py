@@ -0,0 +1,65 @@
+import threading
+import time
+
+import numpy as np
+
+from core.db import listen
+
+NOTIFY_CHANNEL = 'thresholds_changed'
+
+
+class ThresholdCache:
+    """Пороги (telegram_id, sensor, parameter) -> (lower, upper) в памяти процесса.
+
+    Кэш загружается целиком одним запросом и помечается устаревшим по
+    NOTIFY из триггеров на таблицах порогов; TTL страхует от пропущенных
+    уведомлений.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._thresholds = {}
+        self._loaded_at = None
+
+    def reload(self, conn):
+        with conn.cursor() as cur:
+            cur.execute("SELECT telegram_id, sensor, parameter, lower, upper FROM alert_thresholds")
+            rows = cur.fetchall()
+            # Пороги, заданные через бота, имеют приоритет
+            cur.execute("SELECT telegram_id, sensor, parameter, lower_bound, upper_bound FROM parameter_thresholds")
+            rows += cur.fetchall()
+        thresholds = {(tg_id, s, p): (low, high) for tg_id, s, p, low, high in rows}
+        with self._lock:
+            self._thresholds = thresholds
+            self._loaded_at = time.monotonic()
+
+    def refresh_if_stale(self, conn):
+        loaded_at = self._loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at > self.ttl:
+            self.reload(conn)
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    def get(self, telegram_id, sensor, parameter):
+        return self._thresholds.get((int(telegram_id), sensor, parameter))
+
+    def listen(self, connect):
+        # Кэш сбрасывается по каждому уведомлению и после переподключения
+        return listen(connect, [NOTIFY_CHANNEL], lambda notifies: self.invalidate(), self.invalidate,
+                      name="Threshold listener", timeout=self.ttl)
+
+
+def decisive_readings(values, lower, upper, hysteresis):
+    # Индексы (по возрастанию) показаний, по которым понятно состояние их
+    # ряда: вне [lower, upper] (нарушение) или внутри полосы, суженной на hysteresis её ширины (норма), и признак
+    # нарушения для каждого. Показания между границами полос ничего не
+    # меняют. NaN в границе — границы нет.
+    with np.errstate(invalid="ignore"):
+        breach = (values < lower) | (values > upper)
+        margin = np.where(np.isfinite(lower) & np.isfinite(upper), (upper - lower) * hysteresis, 0.0)
+        inside = ~((values < lower + margin) | (values > upper - margin))
+    has_bounds = ~(np.isnan(lower) & np.isnan(upper))
+    idx = np.flatnonzero(has_bounds & ~np.isnan(values) & (breach | inside))
+    return idx, breach[idx]
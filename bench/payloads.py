@@ -0,0 +1,63 @@
+import random
+from datetime import datetime, timedelta
+
+# Нормальные значения лежат в середине допустимой полосы (с запасом на
+# гистерезис), аномальные — далеко за верхней границей
+LOWER, UPPER = 0.0, 100.0
+NORMAL = (40.0, 60.0)
+ANOMALY = 1000.0
+
+
+class PayloadGenerator:
+    """Синтетические записи устройства той же формы, что разбирает flatten.
+
+    У каждого из sensors датчиков params параметров, каждый вложен на depth
+    уровней: {"sensor0": {"g0_1": {"g1_1": {"p1": {"value": .., "unit": ..}}}}}.
+    С вероятностью anomaly_rate на значение у ряда начинается выход за
+    порог на episode показаний (или до конца пачки), после чего значения
+    возвращаются в норму; эпизод может закончиться посреди пачки. Генерация
+    детерминирована seed, так что прогоны на разных коммитах получают
+    одинаковые данные.
+    """
+
+    def __init__(self, sensors=4, params=8, depth=2, anomaly_rate=0.001, episode=3, seed=0):
+        self.anomaly_rate = anomaly_rate
+        self.episode = episode
+        self.rng = random.Random(seed)
+        self.leaves = [
+            (f"sensor{s}", tuple(f"g{level}_{p % 2}" for level in range(depth - 1)) + (f"p{p}",))
+            for s in range(sensors) for p in range(params)
+        ]
+
+    def thresholds(self, telegram_id):
+        # (telegram_id, sensor, parameter, lower, upper) для каждого ряда устройства
+        return [(telegram_id, sensor, ".".join(path), LOWER, UPPER) for sensor, path in self.leaves]
+
+    def records(self, count, start, step=timedelta(seconds=1)):
+        # Возвращает (записи, число начавшихся эпизодов выхода за порог)
+        records, remaining, episodes = [], {}, 0
+        for i in range(count):
+            record = {"timestamp": (start + i * step).isoformat()}
+            for leaf, (sensor, path) in enumerate(self.leaves):
+                if not remaining.get(leaf) and self.rng.random() < self.anomaly_rate:
+                    remaining[leaf] = self.episode
+                    episodes += 1
+                if remaining.get(leaf):
+                    value = ANOMALY
+                    remaining[leaf] -= 1
+                else:
+                    value = round(self.rng.uniform(*NORMAL), 3)
+                node = record.setdefault(sensor, {})
+                for key in path[:-1]:
+                    node = node.setdefault(key, {})
+                node[path[-1]] = {"value": value, "unit": "u"}
+            records.append(record)
+        return records, episodes
+
+
+def device_starts(devices, requests, records, step=timedelta(seconds=1)):
+    # Устройства пишут в непересекающиеся отрезки времени, запросы — подряд;
+    # всё укладывается в прошлое до текущего часа, в существующие разделы
+    span = requests * records * step
+    base = datetime.now().replace(minute=0, second=0, microsecond=0) - devices * span
+    return [base + device * span for device in range(devices)]
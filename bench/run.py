@@ -0,0 +1,284 @@
+"""Нагрузочный прогон цепочки приём -> пороги -> предупреждение.
+
+Нужна одноразовая база PostgreSQL (переменные DB_*, как у сервисов):
+
+    docker run --rm -d -p 5432:5432 -e POSTGRES_PASSWORD=bench postgres:15-alpine
+    DB_HOST=localhost DB_NAME=postgres DB_USER=postgres DB_PASSWORD=bench python -m bench.run
+
+По умолчанию api/app.py поднимается в этом же процессе и вызывается
+через тестовый клиент Flask; с --url запросы идут на уже запущенный
+сервер, который должен отправлять предупреждения в заглушку Bot API:
+
+    TELEGRAM_API_URL=http://localhost:8081 ALERT_COOLDOWN=0 python app.py
+    python -m bench.run --url http://localhost:5000 --stub-port 8081
+
+Результат (строк/с, p50/p99 задержки запросов и доставки предупреждений)
+печатается и сохраняется в JSON; два таких файла сравниваются так:
+
+    python -m bench.run --compare bench/results/old.json bench/results/new.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from core.db import connect
+from core.schema import migrate
+from core.telegram_stub import TelegramStub
+
+from bench.payloads import PayloadGenerator, device_starts
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+# Сравниваемые показатели: путь в результате и направление «лучше»
+METRICS = [
+    (("rows_per_sec",), "higher"),
+    (("latency_ms", "p50"), "lower"),
+    (("latency_ms", "p99"), "lower"),
+    (("alerts", "latency_ms", "p50"), "lower"),
+    (("alerts", "latency_ms", "p99"), "lower"),
+]
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))], 3)
+
+    return {"p50": rank(0.50), "p99": rank(0.99), "max": round(values[-1], 3)}
+
+
+def prepare_database(telegram_ids, generator):
+    # Пороги для синтетических устройств, чистое состояние предупреждений и
+    # никаких показаний от прошлых прогонов: иначе уникальный ключ
+    # (series_id, timestamp) отбросит повторный прогон в тот же час
+    conn = connect()
+    try:
+        migrate(conn)
+        with conn.cursor() as cur:
+            cur.execute("SELECT id FROM sensor_series WHERE telegram_id = ANY(%s)", (telegram_ids,))
+            series_ids = [series_id for series_id, in cur.fetchall()]
+            for table in ("sensor_readings", "sensor_latest", "sensor_rollups"):
+                cur.execute(f"DELETE FROM {table} WHERE series_id = ANY(%s)", (series_ids,))
+            cur.execute("DELETE FROM alert_state WHERE telegram_id = ANY(%s)", (telegram_ids,))
+            cur.execute("DELETE FROM parameter_thresholds WHERE telegram_id = ANY(%s)", (telegram_ids,))
+            for tg_id in telegram_ids:
+                cur.executemany("""
+                    INSERT INTO parameter_thresholds (telegram_id, sensor, parameter, lower_bound, upper_bound)
+                    VALUES (%s, %s, %s, %s, %s)
+                """, generator.thresholds(tg_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def in_process_client(stub):
+    # start() подключает api/app.py к базе и запускает фоновые потоки;
+    # без паузы между срабатываниями каждый эпизод аномалии даёт сообщение
+    os.environ.setdefault("BOT_TOKEN", "bench")
+    os.environ.setdefault("ALERT_COOLDOWN", "0")
+    os.environ["TELEGRAM_API_URL"] = stub.url
+    sys.path.insert(0, API_DIR)
+    import app as api
+
+    api.start()
+    api.thresholds.invalidate()
+    local = threading.local()
+
+    def post(payload):
+        if not hasattr(local, "client"):
+            local.client = api.app.test_client()
+        response = local.client.post("/api/v1/data", data=payload, content_type="application/json")
+        return response.status_code, response.get_json()
+
+    return post
+
+
+def http_client(url):
+    import requests
+
+    local = threading.local()
+
+    def post(payload):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        response = local.session.post(f"{url.rstrip('/')}/api/v1/data", data=payload,
+                                      headers={"Content-Type": "application/json"})
+        return response.status_code, response.json()
+
+    return post
+
+
+def wait_for_alerts(stub, timeout, settle):
+    # Ждём, пока сообщения перестанут приходить (диспетчер шлёт их с задержками)
+    deadline = time.monotonic() + timeout
+    seen, quiet_since = -1, time.monotonic()
+    while time.monotonic() < deadline:
+        count = len(stub.messages)
+        if count != seen:
+            seen, quiet_since = count, time.monotonic()
+        elif time.monotonic() - quiet_since >= settle:
+            break
+        time.sleep(0.1)
+
+
+def alert_latencies(sent, messages):
+    # sent: {chat_id: [время начала запросов с аномалиями]}. Сообщения по чату
+    # склеиваются в дайджесты, поэтому сообщение закрывает все запросы,
+    # начатые до его получения, а задержка считается от самого раннего из них
+    latencies = []
+    pending = {chat: sorted(times) for chat, times in sent.items()}
+    for message in sorted(messages, key=lambda m: m["received_at"]):
+        times = pending.get(int(message["chat_id"]), [])
+        covered = [t for t in times if t <= message["received_at"]]
+        if covered:
+            latencies.append((message["received_at"] - covered[0]) * 1000)
+            pending[int(message["chat_id"])] = times[len(covered):]
+    return latencies
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    generator = PayloadGenerator(sensors=args.sensors, params=args.params, depth=args.depth,
+                                 anomaly_rate=args.anomaly_rate, episode=args.episode, seed=args.seed)
+    telegram_ids = [args.telegram_id_base + d for d in range(args.devices)]
+    prepare_database(telegram_ids, generator)
+
+    stub = TelegramStub(("127.0.0.1", args.stub_port))
+    stub.start()
+    post = http_client(args.url) if args.url else in_process_client(stub)
+    if args.url:
+        time.sleep(1)  # сервер узнаёт о новых порогах по NOTIFY
+
+    # Запросы готовятся заранее, чтобы генерация не входила в замер;
+    # устройства перемежаются, как при одновременной работе
+    starts = device_starts(args.devices, args.requests, args.records)
+    payloads = []
+    for r in range(args.requests):
+        for d, tg_id in enumerate(telegram_ids):
+            records, anomalies = generator.records(args.records, starts[d] + timedelta(seconds=r * args.records))
+            payloads.append((tg_id, json.dumps({"telegram_id": tg_id, "data": records}), anomalies))
+
+    results = []
+    lock = threading.Lock()
+
+    def send(item):
+        tg_id, payload, anomalies = item
+        started_at = time.time()
+        t0 = time.perf_counter()
+        try:
+            status, body = post(payload)
+        except Exception as e:
+            status, body = None, {"error": str(e)}
+        latency = (time.perf_counter() - t0) * 1000
+        rows = (body or {}).get("inserted", (body or {}).get("accepted", 0))
+        with lock:
+            results.append((tg_id, started_at, latency, status, rows, anomalies))
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(send, payloads))
+    duration = time.perf_counter() - t0
+    wait_for_alerts(stub, args.alert_timeout, args.alert_settle)
+    stub.shutdown()
+
+    ok = [r for r in results if r[3] in (201, 202)]
+    sent = {}
+    for tg_id, started_at, _, _, _, anomalies in ok:
+        if anomalies:
+            sent.setdefault(tg_id, []).append(started_at)
+    chats = set(telegram_ids)
+    messages = [m for m in stub.messages if int(m["chat_id"]) in chats]
+    rows = sum(r[4] for r in ok)
+
+    return {
+        "commit": git_commit(),
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "mode": args.url or "test-client",
+        "config": {k: getattr(args, k) for k in (
+            "devices", "requests", "records", "sensors", "params", "depth", "anomaly_rate", "episode", "seed", "concurrency")},
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "rows": rows,
+        "duration_s": round(duration, 3),
+        "rows_per_sec": round(rows / duration, 1) if duration else None,
+        "latency_ms": percentiles([r[2] for r in ok]),
+        "alerts": {
+            "anomalous_requests": sum(len(times) for times in sent.values()),
+            "messages": len(messages),
+            "latency_ms": percentiles(alert_latencies(sent, messages)),
+        },
+    }
+
+
+def lookup(result, path):
+    for key in path:
+        result = (result or {}).get(key)
+    return result
+
+
+def compare(old, new):
+    print(f"{'metric':<24}{'old':>12}{'new':>12}{'change':>10}")
+    for path, better in METRICS:
+        a, b = lookup(old, path), lookup(new, path)
+        change = ""
+        if a and b is not None:
+            delta = (b - a) / a * 100
+            worse = delta < 0 if better == "higher" else delta > 0
+            change = f"{delta:+.1f}%" + (" !" if worse and abs(delta) >= 10 else "")
+        print(f"{'.'.join(path):<24}{a if a is not None else '-':>12}{b if b is not None else '-':>12}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    parser.add_argument("--url", help="адрес запущенного API; по умолчанию — тестовый клиент Flask")
+    parser.add_argument("--stub-port", type=int, default=0, help="порт заглушки Bot API (0 — любой свободный)")
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=20, help="запросов на устройство")
+    parser.add_argument("--records", type=int, default=50, help="записей в запросе")
+    parser.add_argument("--sensors", type=int, default=4)
+    parser.add_argument("--params", type=int, default=8, help="параметров на датчик")
+    parser.add_argument("--depth", type=int, default=2, help="уровней вложенности параметра")
+    parser.add_argument("--anomaly-rate", type=float, default=0.001)
+    parser.add_argument("--episode", type=int, default=3, help="показаний в эпизоде выхода за порог")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--telegram-id-base", type=int, default=-9_000_000_000)
+    parser.add_argument("--alert-timeout", type=float, default=60)
+    parser.add_argument("--alert-settle", type=float, default=3)
+    parser.add_argument("--output", help="файл результата; по умолчанию bench/results/<коммит>-<время>.json")
+    args = parser.parse_args()
+
+    if args.compare:
+        old, new = (json.load(open(path, encoding="utf-8")) for path in args.compare)
+        compare(old, new)
+        return
+
+    result = run(args)
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{(result['commit'] or 'unknown')[:12]}-{datetime.now():%Y%m%dT%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    print(f"Сохранено: {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,124 @@
 import requests
 import json
+import sys
+import time
+import uuid
+import zlib
+from array import array
 
 TELEGRAM_ID = 902075408  # ← замените на свой
 SERVER_URL = "http://45.12.134.3:5000/api/v1/data"
+DATA_FILE = "output2.json"
 
-with open("output2.json", "r", encoding="utf-8") as f:
-    raw_data = json.load(f)
+# python client.py          — весь файл одним JSON-запросом
+# python client.py --stream — потоком NDJSON со сжатием gzip (для больших выгрузок);
+#                             файл *.ndjson передаётся построчно, не загружаясь в память
+# python client.py --packed — одной пачкой MessagePack: словарь рядов и столбцы значений
+STREAM = "--stream" in sys.argv
+PACKED = "--packed" in sys.argv
+RETRIES = 3
 
-payload = {
-    "telegram_id": TELEGRAM_ID,
-    "data": raw_data
-}
 
-response = requests.post(SERVER_URL, json=payload)
+def ndjson_lines(path):
+    if path.endswith(".ndjson"):
+        with open(path, "rb") as f:
+            yield from f
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        records = json.load(f)
+    for record in records:
+        yield (json.dumps(record, ensure_ascii=False) + "\n").encode()
+
+
+def gzip_chunks(lines, chunk_size=64 << 10):
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    pending = []
+    size = 0
+    for line in lines:
+        pending.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield compressor.compress(b"".join(pending))
+            pending, size = [], 0
+    yield compressor.compress(b"".join(pending)) + compressor.flush()
+
+
+def pack_records(records, telegram_id):
+    import msgpack
+
+    series, timestamps = {}, {}
+    series_ids, timestamp_ids, values = array("I"), array("I"), array("d")
+
+    def walk(node, sensor, path, ts_id):
+        for key, val in node.items():
+            full_path = f"{path}.{key}" if path else key
+            if isinstance(val, dict) and "value" in val and "unit" in val:
+                series_ids.append(series.setdefault((sensor, full_path, val["unit"]), len(series)))
+                timestamp_ids.append(ts_id)
+                values.append(float("nan") if val["value"] is None else val["value"])
+            elif isinstance(val, dict):
+                walk(val, sensor, full_path, ts_id)
+
+    for record in records:
+        ts_id = timestamps.setdefault(record.get("timestamp"), len(timestamps))
+        for sensor, content in record.items():
+            if sensor != "timestamp":
+                walk(content, sensor, "", ts_id)
+
+    if sys.byteorder == "big":
+        for column in (series_ids, timestamp_ids, values):
+            column.byteswap()
+    return msgpack.packb({
+        "telegram_id": telegram_id,
+        "series": [list(key) for key in series],
+        "timestamps": list(timestamps),
+        "series_ids": series_ids.tobytes(),
+        "timestamp_ids": timestamp_ids.tobytes(),
+        "values": values.tobytes(),
+    }, use_bin_type=True)
+
+
+def post_batch(**kwargs):
+    # Повтор после таймаута или 5xx — с тем же Idempotency-Key, так что
+    # пачка, уже принятая сервером, не запишется второй раз
+    headers = {**kwargs.pop("headers", {}), "Idempotency-Key": str(uuid.uuid4())}
+    for attempt in range(RETRIES + 1):
+        try:
+            response = requests.post(SERVER_URL, headers=headers, timeout=60, **kwargs)
+            if response.status_code < 500 or attempt == RETRIES:
+                return response
+        except requests.RequestException:
+            if attempt == RETRIES:
+                raise
+        time.sleep(2 ** attempt)
+
+
+if STREAM:
+    # Генератор в data= requests отправляет с Transfer-Encoding: chunked
+    response = requests.post(
+        f"{SERVER_URL}/stream",
+        params={"telegram_id": TELEGRAM_ID},
+        data=gzip_chunks(ndjson_lines(DATA_FILE)),
+        headers={"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"},
+    )
+elif PACKED:
+    with open(DATA_FILE, "r", encoding="utf-8") as f:
+        raw_data = json.load(f)
+
+    response = post_batch(
+        data=pack_records(raw_data, TELEGRAM_ID),
+        headers={"Content-Type": "application/msgpack"},
+    )
+else:
+    with open(DATA_FILE, "r", encoding="utf-8") as f:
+        raw_data = json.load(f)
+
+    payload = {
+        "telegram_id": TELEGRAM_ID,
+        "data": raw_data
+    }
+
+    response = post_batch(json=payload)
+
 print("Status:", response.status_code)
 print("Response:", response.json())
@@ -0,0 +1,135 @@
+import os
+from datetime import datetime, timedelta, timezone
+
+from psycopg2.extras import execute_values
+
+OK, PENDING, FIRING = "ok", "pending", "firing"
+# События, о которых сообщается пользователю
+FIRED, RESOLVED = "fired", "resolved"
+
+SCHEMA = """
+    -- Состояние предупреждений по рядам; source — 'threshold' (API) или 'anomaly' (analyzer)
+    CREATE TABLE alert_state (
+        telegram_id BIGINT NOT NULL,
+        sensor TEXT NOT NULL,
+        parameter TEXT NOT NULL,
+        source TEXT NOT NULL,
+        state TEXT NOT NULL,
+        since TIMESTAMP,
+        notified BOOLEAN NOT NULL DEFAULT FALSE,
+        last_value DOUBLE PRECISION,
+        last_notified_at TIMESTAMP,
+        updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (telegram_id, sensor, parameter, source)
+    );
+"""
+
+
+class AlertPolicy:
+    """Параметры автомата предупреждений.
+
+    min_duration — сколько секунд (по времени показаний) нарушение должно
+    держаться, прежде чем предупреждение сработает; cooldown — не чаще
+    одного сообщения о срабатывании ряда за столько секунд (по часам
+    сервера: это ограничение частоты сообщений); hysteresis — доля ширины
+    допустимой полосы, на которую значение должно вернуться внутрь, чтобы
+    нарушение считалось снятым (применяется при классификации наблюдений).
+    """
+
+    def __init__(self, min_duration=0.0, cooldown=300.0, hysteresis=0.05):
+        self.min_duration = timedelta(seconds=min_duration)
+        self.cooldown = timedelta(seconds=cooldown)
+        self.hysteresis = hysteresis
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            min_duration=float(os.environ.get('ALERT_MIN_DURATION', '0')),
+            cooldown=float(os.environ.get('ALERT_COOLDOWN', '300')),
+            hysteresis=float(os.environ.get('ALERT_HYSTERESIS', '0.05')),
+        )
+
+
+class _State:
+    __slots__ = ("state", "since", "notified", "last_value", "last_notified_at")
+
+    def __init__(self, state=OK, since=None, notified=False, last_value=None, last_notified_at=None):
+        self.state = state
+        self.since = since
+        self.notified = notified
+        self.last_value = last_value
+        self.last_notified_at = last_notified_at
+
+
+def _reading_time(observation):
+    # Показания без времени — в начало, в порядке поступления
+    return observation[0] or datetime.min
+
+
+def evaluate(cur, source, observations, policy, now=None):
+    """Прогоняет наблюдения через автомат OK -> PENDING -> FIRING -> OK.
+
+    observations: {(telegram_id, sensor, parameter): [(timestamp, breach, value, detail), ...]} —
+    решающие наблюдения ряда в пачке (упорядочиваются по времени): breach=True —
+    нарушение, False — значение уверенно вернулось в норму (с учётом
+    гистерезиса). Ряд проходит их все, так что нарушение посреди пачки не
+    теряется. Длительность нарушения считается по timestamp показаний
+    (None — текущее время). Состояние читается FOR UPDATE и записывается в
+    той же транзакции, так что API и analyzer разделяют его. Возвращает
+    события [(key, FIRED | RESOLVED, value, detail)] — только переходы, о
+    которых нужно сообщить, в порядке наблюдений.
+    """
+    if not observations:
+        return []
+    now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+    keys = sorted(observations)
+    tg_ids, sensors, params = zip(*keys)
+    cur.execute("""
+        SELECT a.telegram_id, a.sensor, a.parameter, a.state, a.since, a.notified, a.last_value, a.last_notified_at
+        FROM alert_state a
+        JOIN unnest(%s::bigint[], %s::text[], %s::text[]) AS k (telegram_id, sensor, parameter)
+            USING (telegram_id, sensor, parameter)
+        WHERE a.source = %s
+        ORDER BY a.telegram_id, a.sensor, a.parameter
+        FOR UPDATE OF a
+    """, (list(tg_ids), list(sensors), list(params), source))
+    states = {(tg_id, s, p): _State(*rest) for tg_id, s, p, *rest in cur.fetchall()}
+
+    events, changed = [], []
+    for key in keys:
+        st = states.get(key) or _State()
+        touched = False
+        for timestamp, breach, value, detail in sorted(observations[key], key=_reading_time):
+            if not breach and st.state == OK:
+                continue
+            at = timestamp or now
+            if breach:
+                if st.state == OK:
+                    st.state, st.since, st.notified = PENDING, at, False
+                if st.state == PENDING and at - st.since >= policy.min_duration:
+                    st.state = FIRING
+                # Срабатывание, подавленное паузой, сообщается, когда она истечёт
+                if st.state == FIRING and not st.notified and (
+                        st.last_notified_at is None or now - st.last_notified_at >= policy.cooldown):
+                    st.notified, st.last_notified_at = True, now
+                    events.append((key, FIRED, value, detail))
+            else:
+                if st.state == FIRING and st.notified:
+                    events.append((key, RESOLVED, value, detail))
+                st.state, st.since, st.notified = OK, None, False
+            st.last_value = value
+            touched = True
+        if touched:
+            changed.append((*key, source, st.state, st.since, st.notified, st.last_value, st.last_notified_at))
+
+    if changed:
+        execute_values(cur, """
+            INSERT INTO alert_state
+                (telegram_id, sensor, parameter, source, state, since, notified, last_value, last_notified_at)
+            VALUES %s
+            ON CONFLICT (telegram_id, sensor, parameter, source) DO UPDATE SET
+                state = EXCLUDED.state, since = EXCLUDED.since, notified = EXCLUDED.notified,
+                last_value = EXCLUDED.last_value, last_notified_at = EXCLUDED.last_notified_at,
+                updated_at = NOW()
+        """, changed)
+    return events
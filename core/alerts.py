@@ -0,0 +1,206 @@
+import queue
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from core import metrics
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+MESSAGE_LIMIT = 4096
+
+ALERTS_SENT = metrics.Counter("alerts_sent_total", "Предупреждения, доставленные в Telegram")
+ALERTS_FAILED = metrics.Counter("alerts_failed_total", "Неудачные отправки и потерянные предупреждения", ["reason"])
+ALERT_SEND_SECONDS = metrics.Histogram("alert_send_seconds", "Длительность запроса sendMessage")
+ALERT_DELIVERY_SECONDS = metrics.Histogram("alert_delivery_seconds", "От постановки в очередь до доставки")
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Pending:
+    __slots__ = ("texts", "queued_at", "attempts", "not_before")
+
+    def __init__(self):
+        self.texts = []
+        self.queued_at = []
+        self.attempts = 0
+        self.not_before = 0.0
+
+
+class AlertDispatcher:
+    """Фоновая отправка предупреждений в Telegram.
+
+    send() только кладёт сообщение в ограниченную очередь. Рабочий поток
+    склеивает всё накопившееся для одного чата в дайджест, соблюдает
+    лимиты Telegram (около 30 сообщений/с всего и 1/с на чат) и повторяет
+    отправку с экспоненциальной задержкой при 429, 5xx и сетевых ошибках.
+    """
+
+    def __init__(self, token, api_url=TELEGRAM_API_URL, parse_mode="HTML", queue_size=1000,
+                 global_rate=30, chat_rate=1, max_retries=5, timeout=5):
+        self.url = f"{api_url.rstrip('/')}/bot{token}/sendMessage"
+        self.parse_mode = parse_mode
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.chat_rate = chat_rate
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._global = TokenBucket(global_rate, capacity=global_rate)
+        self._chats = {}
+        self._pending = {}
+        self._unfinished = 0
+        self._done = threading.Condition()
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self._session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def send(self, chat_id, text):
+        with self._done:
+            try:
+                self._queue.put_nowait((chat_id, text, time.monotonic()))
+            except queue.Full:
+                self.dropped += 1
+                ALERTS_FAILED.labels("queue_full").inc()
+                print("Alert queue full, dropping alert for", chat_id)
+                return
+            self._unfinished += 1
+
+    def join(self, timeout=None):
+        # Ждёт, пока все принятые предупреждения не будут отправлены или отброшены
+        with self._done:
+            return self._done.wait_for(lambda: self._unfinished == 0, timeout)
+
+    def _task_done(self, count):
+        with self._done:
+            self._unfinished -= count
+            if not self._unfinished:
+                self._done.notify_all()
+
+    def _run(self):
+        while True:
+            timeout = self._next_wakeup()
+            try:
+                self._add(*self._queue.get(timeout=timeout))
+                while True:
+                    self._add(*self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            self._flush_ready()
+
+    def _add(self, chat_id, text, queued_at):
+        pending = self._pending.setdefault(chat_id, _Pending())
+        pending.texts.append(text)
+        pending.queued_at.append(queued_at)
+
+    def _next_wakeup(self):
+        if not self._pending:
+            return None
+        now = time.monotonic()
+        waits = [
+            max(p.not_before - now, self._chat_bucket(chat_id).wait_time(now))
+            for chat_id, p in self._pending.items()
+        ]
+        return max(min(waits), self._global.wait_time(now), 0.001)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate)
+        return bucket
+
+    def _flush_ready(self):
+        for chat_id in list(self._pending):
+            pending = self._pending[chat_id]
+            now = time.monotonic()
+            bucket = self._chat_bucket(chat_id)
+            if pending.not_before > now or bucket.wait_time(now) or self._global.wait_time(now):
+                continue
+            bucket.take(now)
+            self._global.take(now)
+
+            text, rest = self._digest(pending.texts)
+            retry_after = self._deliver(chat_id, text)
+            if retry_after is None or pending.attempts >= self.max_retries:
+                taken = len(pending.texts) - len(rest)
+                if retry_after is not None:
+                    ALERTS_FAILED.labels("gave_up").inc(taken)
+                    print(f"Failed to send alert to {chat_id} after {pending.attempts + 1} attempts")
+                else:
+                    delivered_at = time.monotonic()
+                    for queued_at in pending.queued_at[:taken]:
+                        ALERT_DELIVERY_SECONDS.observe(delivered_at - queued_at)
+                self._task_done(taken)
+                pending.texts = rest
+                pending.queued_at = pending.queued_at[taken:]
+                pending.attempts = 0
+            else:
+                pending.attempts += 1
+                pending.not_before = now + retry_after
+            if not pending.texts:
+                del self._pending[chat_id]
+
+        if len(self._chats) > 10000:
+            now = time.monotonic()
+            self._chats = {c: b for c, b in self._chats.items() if c in self._pending or b.wait_time(now)}
+
+    @staticmethod
+    def _digest(texts):
+        # Склеивает подряд идущие сообщения, пока они влезают в лимит Telegram
+        text = texts[0][:MESSAGE_LIMIT]
+        taken = 1
+        for t in texts[1:]:
+            if len(text) + 2 + len(t) > MESSAGE_LIMIT:
+                break
+            text += "\n\n" + t
+            taken += 1
+        return text, texts[taken:]
+
+    def _deliver(self, chat_id, text):
+        # None — отправлено (или отброшено без повтора), иначе задержка до повтора
+        data = {"chat_id": chat_id, "text": text}
+        if self.parse_mode:
+            data["parse_mode"] = self.parse_mode
+        backoff = min(2 ** self._pending[chat_id].attempts, 60)
+        try:
+            with ALERT_SEND_SECONDS.time():
+                resp = self._session.post(self.url, json=data, timeout=self.timeout)
+        except requests.RequestException as e:
+            ALERTS_FAILED.labels("network").inc()
+            print("Failed to send alert:", e)
+            return backoff
+        if resp.status_code == 429:
+            ALERTS_FAILED.labels("throttled").inc()
+            try:
+                return resp.json()["parameters"]["retry_after"]
+            except (ValueError, KeyError, TypeError):
+                return backoff
+        if resp.status_code >= 500:
+            ALERTS_FAILED.labels("server_error").inc()
+            return backoff
+        if not resp.ok:
+            ALERTS_FAILED.labels("rejected").inc()
+            print("Telegram rejected alert:", resp.status_code, resp.text)
+        else:
+            ALERTS_SENT.inc()
+        return None
@@ -0,0 +1,158 @@
+import os
+import select
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import pool
+
+
+def db_params():
+    return dict(
+        host=os.environ['DB_HOST'],
+        database=os.environ['DB_NAME'],
+        user=os.environ['DB_USER'],
+        password=os.environ['DB_PASSWORD'],
+        connect_timeout=int(os.environ.get('DB_CONNECT_TIMEOUT', '5')),
+    )
+
+
+def connect(retries=10, delay=3, **params):
+    params = params or db_params()
+    for _ in range(retries):
+        try:
+            return psycopg2.connect(**params)
+        except psycopg2.OperationalError:
+            print("⏳ Ожидаем готовности PostgreSQL...")
+            time.sleep(delay)
+    raise RuntimeError("❌ Не удалось подключиться к PostgreSQL")
+
+
+def listen(connect, channels, on_notify, on_reconnect, name="Listener", timeout=60, retry_delay=5):
+    """Фоновый поток LISTEN на channels с переподключением.
+
+    connect() открывает отдельное соединение (Database.connect). Пачки
+    уведомлений psycopg2 (.channel, .payload) передаются в on_notify;
+    on_reconnect() вызывается после каждого подключения и после обрыва:
+    пока соединения не было, уведомления могли потеряться. Колбэки
+    выполняются в потоке слушателя. Возвращает запущенный поток.
+    """
+    thread = threading.Thread(
+        target=_listen_loop, args=(connect, channels, on_notify, on_reconnect, name, timeout, retry_delay),
+        daemon=True,
+    )
+    thread.start()
+    return thread
+
+
+def _listen_loop(connect, channels, on_notify, on_reconnect, name, timeout, retry_delay):
+    while True:
+        conn = None
+        try:
+            conn = connect()
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                for channel in channels:
+                    cur.execute(f"LISTEN {channel}")
+            on_reconnect()
+            while True:
+                if select.select([conn], [], [], timeout) == ([], [], []):
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    notifies = list(conn.notifies)
+                    conn.notifies.clear()
+                    on_notify(notifies)
+        except (psycopg2.Error, RuntimeError) as e:
+            print(f"{name} failed:", e)
+            if conn is not None:
+                conn.close()
+            on_reconnect()
+            time.sleep(retry_delay)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class Database:
+    """Пул соединений для многопоточных сервисов.
+
+    connection() выдаёт соединение на время блока: коммит при успехе,
+    откат при исключении. Соединение, простоявшее дольше
+    health_check_interval, перед выдачей проверяется SELECT 1; разорванные
+    соединения (например, после перезапуска PostgreSQL) закрываются и
+    заменяются новыми.
+    """
+
+    def __init__(self, minconn=1, maxconn=10, checkout_timeout=10, health_check_interval=30, **params):
+        self.params = params or db_params()
+        self.maxconn = maxconn
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        connect(**self.params).close()
+        self._pool = pool.ThreadedConnectionPool(minconn, maxconn, **self.params)
+        # ThreadedConnectionPool не ждёт освобождения соединения, а сразу падает
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            minconn=int(os.environ.get('DB_POOL_MIN', '1')),
+            maxconn=int(os.environ.get('DB_POOL_MAX', '10')),
+            checkout_timeout=float(os.environ.get('DB_POOL_TIMEOUT', '10')),
+            health_check_interval=float(os.environ.get('DB_HEALTH_CHECK_INTERVAL', '30')),
+        )
+
+    def connect(self):
+        return connect(**self.params)
+
+    @contextmanager
+    def connection(self):
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            raise PoolTimeout("no database connection available")
+        try:
+            conn = self._checkout()
+            broken = False
+            try:
+                yield conn
+                conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+                raise
+            except BaseException:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                broken = broken or bool(conn.closed)
+                if broken:
+                    self._last_used.pop(id(conn), None)
+                else:
+                    self._last_used[id(conn)] = time.monotonic()
+                self._pool.putconn(conn, close=broken)
+        finally:
+            self._slots.release()
+
+    def _checkout(self):
+        for _ in range(3):
+            conn = self._pool.getconn()
+            idle = time.monotonic() - self._last_used.get(id(conn), 0)
+            if not conn.closed and idle < self.health_check_interval:
+                return conn
+            try:
+                if not conn.closed:
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT 1")
+                    conn.rollback()
+                    return conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                pass
+            self._last_used.pop(id(conn), None)
+            self._pool.putconn(conn, close=True)
+        return self._pool.getconn()
+
+    def close(self):
+        self._pool.closeall()
@@ -0,0 +1,116 @@
+import csv
+import io
+import itertools
+
+COLUMNS = ("timestamp", "sensor", "parameter", "value", "unit")
+CHUNK_ROWS = 10_000
+ROW_GROUP_ROWS = 100_000
+
+
+def open_export(conn, telegram_id, sensor=None, parameter=None, start=None, end=None, itersize=CHUNK_ROWS):
+    """Именованный (серверный) курсор по показаниям telegram_id.
+
+    Строки (timestamp, sensor, parameter, value, unit) идут по рядам, внутри
+    ряда — по времени, как в индексе (series_id, timestamp); клиент получает
+    их порциями по itersize, так что объём выгрузки не ограничен памятью.
+    Курсор живёт до конца транзакции conn.
+    """
+    conditions, params = ["s.telegram_id = %s"], [telegram_id]
+    for column, value in (("s.sensor", sensor), ("s.parameter", parameter)):
+        if value is not None:
+            conditions.append(f"{column} = %s")
+            params.append(value)
+    if start is not None:
+        conditions.append("r.timestamp >= %s")
+        params.append(start)
+    if end is not None:
+        conditions.append("r.timestamp < %s")
+        params.append(end)
+    cur = conn.cursor(name="sensor_export")
+    cur.itersize = itersize
+    cur.execute(f"""
+        SELECT r.timestamp, s.sensor, s.parameter, r.value, u.name
+        FROM sensor_readings r
+        JOIN sensor_series s ON s.id = r.series_id
+        LEFT JOIN units u ON u.id = r.unit_id
+        WHERE {" AND ".join(conditions)}
+        ORDER BY r.series_id, r.timestamp
+    """, params)
+    return cur
+
+
+def _chunks(cur, size):
+    rows = iter(cur)
+    return iter(lambda: list(itertools.islice(rows, size)), [])
+
+
+def csv_chunks(cur, chunk_rows=CHUNK_ROWS):
+    # Заголовок, затем по куску на chunk_rows строк
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(COLUMNS)
+    yield buffer.getvalue().encode()
+    for rows in _chunks(cur, chunk_rows):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows((ts.isoformat() if ts else "", s, p, v, u) for ts, s, p, v, u in rows)
+        yield buffer.getvalue().encode()
+
+
+class _Drain:
+    # Файлоподобный приёмник для ParquetWriter: записанное забирается take()
+    closed = False
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+def parquet_chunks(cur, row_group_rows=ROW_GROUP_ROWS):
+    # Группа строк Parquet на row_group_rows строк; в памяти — одна группа
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("timestamp", pa.timestamp("us")),
+        ("sensor", pa.string()),
+        ("parameter", pa.string()),
+        ("value", pa.float64()),
+        ("unit", pa.string()),
+    ])
+    sink = _Drain()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        for rows in _chunks(cur, row_group_rows):
+            columns = list(zip(*rows))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema))
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv", csv_chunks),
+    "parquet": ("application/vnd.apache.parquet", "parquet", parquet_chunks),
+}
@@ -0,0 +1,190 @@
+import threading
+from datetime import datetime, timezone
+from itertools import repeat
+
+import numpy as np
+
+LAYOUT_CACHE_SIZE = 64
+LAYOUTS_PER_SIGNATURE = 4
+
+
+class Layout:
+    """Скомпилированная раскладка записи устройства.
+
+    leaves — (датчик, параметр) для каждого листа {"value": .., "unit": ..}
+    в порядке обхода; extract(record, values, units) — сгенерированная под
+    эту форму функция, которая дописывает значения и единицы листьев без
+    рекурсии и поднимает KeyError/TypeError, если форма записи другая.
+    """
+
+    __slots__ = ("leaves", "extract")
+
+    def __init__(self, leaves, extract):
+        self.leaves = leaves
+        self.extract = extract
+
+
+def compile_layout(record):
+    leaves, leaf_vars = [], []
+    lines = ["def extract(n0, values, units):", f"    if len(n0) != {len(record)}: raise KeyError"]
+    counter = [0]
+
+    def child_of(var, key):
+        counter[0] += 1
+        child = f"n{counter[0]}"
+        lines.append(f"    {child} = {var}[{key!r}]")
+        return child
+
+    def node(nested, var, sensor, path):
+        lines.append(f"    if len({var}) != {len(nested)}: raise KeyError")
+        for key, val in nested.items():
+            full_path = f"{path}.{key}" if path else key
+            if isinstance(val, dict) and "value" in val and "unit" in val:
+                leaves.append((sensor, full_path))
+                leaf_vars.append(child_of(var, key))
+            elif isinstance(val, dict):
+                node(val, child_of(var, key), sensor, full_path)
+            else:
+                # flatten пропускает не-словари, но они не должны стать словарями
+                lines.append(f"    if isinstance({var}[{key!r}], dict): raise KeyError")
+
+    for sensor, content in record.items():
+        if sensor == "timestamp":
+            continue
+        if not isinstance(content, dict):
+            raise TypeError(f"sensor {sensor!r} content must be an object")
+        node(content, child_of("n0", sensor), sensor, "")
+
+    lines.append("    values += (" + "".join(f"{v}['value'], " for v in leaf_vars) + ")")
+    lines.append("    units += (" + "".join(f"{v}['unit'], " for v in leaf_vars) + ")")
+    namespace = {}
+    exec("\n".join(lines), namespace)
+    return Layout(leaves, namespace["extract"])
+
+
+_layouts = {}
+_layouts_lock = threading.Lock()
+
+
+def extract_record(record, values, units):
+    # Раскладки ищутся по ключам верхнего уровня; под одними ключами может
+    # встречаться несколько форм вложенности, последняя удачная — первая
+    signature = tuple(record)
+    candidates = _layouts.get(signature, ())
+    start = len(values)
+    for i, layout in enumerate(candidates):
+        try:
+            layout.extract(record, values, units)
+        except (KeyError, TypeError):
+            del values[start:], units[start:]
+            continue
+        if i:
+            with _layouts_lock:
+                _layouts[signature] = [layout] + [c for c in candidates if c is not layout]
+        return layout
+    layout = compile_layout(record)
+    layout.extract(record, values, units)
+    with _layouts_lock:
+        if len(_layouts) >= LAYOUT_CACHE_SIZE:
+            _layouts.clear()
+        _layouts[signature] = [layout] + list(_layouts.get(signature, ()))[:LAYOUTS_PER_SIGNATURE - 1]
+    return layout
+
+
+class FlatBatch:
+    """Развёрнутые показания пачки записей в виде столбцов.
+
+    sensor_ids и parameter_ids — индексы в словарях sensors и parameters,
+    values — float64 (NaN там, где значение отсутствовало).
+    """
+
+    def __init__(self, timestamps, sensor_ids, parameter_ids, values, units, sensors, parameters):
+        self.timestamps = timestamps
+        self.sensor_ids = sensor_ids
+        self.parameter_ids = parameter_ids
+        self.values = values
+        self.units = units
+        self.sensors = sensors
+        self.parameters = parameters
+
+    def __len__(self):
+        return len(self.values)
+
+    def sensor(self, i):
+        return self.sensors[self.sensor_ids[i]]
+
+    def parameter(self, i):
+        return self.parameters[self.parameter_ids[i]]
+
+    def rows(self, telegram_id):
+        values = self.values.tolist()
+        if np.isnan(self.values).any():
+            values = [None if v != v else v for v in values]
+        sensors = np.array(self.sensors, dtype=object)[self.sensor_ids].tolist()
+        parameters = np.array(self.parameters, dtype=object)[self.parameter_ids].tolist()
+        return list(zip(repeat(telegram_id), self.timestamps, sensors, parameters, values, self.units))
+
+    def bounds(self, lookup):
+        # lookup(sensor, parameter) -> (lower, upper) или None, вызывается по разу на ряд
+        n_params = len(self.parameters)
+        series, inverse = np.unique(self.sensor_ids * n_params + self.parameter_ids, return_inverse=True)
+        lower = np.full(len(series), np.nan)
+        upper = np.full(len(series), np.nan)
+        for j, key in enumerate(series.tolist()):
+            threshold = lookup(self.sensors[key // n_params], self.parameters[key % n_params])
+            if threshold:
+                lower[j], upper[j] = (np.nan if b is None else b for b in threshold)
+        return lower[inverse], upper[inverse]
+
+
+def parse_timestamp(value):
+    # ISO 8601 -> naive UTC datetime (так хранит sensor_readings); None — нет
+    # времени. Смещение или Z учитываются; ValueError/TypeError — не время
+    if value is None or isinstance(value, datetime):
+        ts = value
+    elif isinstance(value, str):
+        ts = datetime.fromisoformat(value)
+    else:
+        raise TypeError(f"timestamp must be an ISO 8601 string, got {type(value).__name__}")
+    if ts is not None and ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def check_units(units):
+    if not all(u is None or isinstance(u, str) for u in units):
+        raise TypeError("unit must be a string")
+
+
+def flatten_records(records):
+    timestamps = []
+    values, units = [], []
+    runs = []
+
+    for record in records:
+        layout = extract_record(record, values, units)
+        timestamps.extend([parse_timestamp(record.get("timestamp"))] * len(layout.leaves))
+        if runs and runs[-1][0] is layout:
+            runs[-1][1] += 1
+        else:
+            runs.append([layout, 1])
+
+    check_units(units)
+    sensors, parameters = {}, {}
+    sensor_ids, parameter_ids = [], []
+    for layout, count in runs:
+        sensor_ids.append(np.tile(np.array(
+            [sensors.setdefault(s, len(sensors)) for s, _ in layout.leaves], dtype=np.int64), count))
+        parameter_ids.append(np.tile(np.array(
+            [parameters.setdefault(p, len(parameters)) for _, p in layout.leaves], dtype=np.int64), count))
+
+    empty = np.empty(0, dtype=np.int64)
+    return FlatBatch(
+        timestamps=timestamps,
+        sensor_ids=np.concatenate(sensor_ids) if sensor_ids else empty,
+        parameter_ids=np.concatenate(parameter_ids) if parameter_ids else empty,
+        values=np.array(values, dtype=np.float64),
+        units=units,
+        sensors=list(sensors),
+        parameters=list(parameters),
+    )
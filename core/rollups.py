@@ -0,0 +1,212 @@
+from datetime import datetime
+
+from psycopg2.extras import execute_values
+
+# Уровни агрегации sensor_rollups, секунды на корзину
+RESOLUTIONS = (60, 3600, 86400)
+# По этому уровню оценивается, с какого момента начинаются последние N показаний
+WINDOW_RESOLUTION = 3600
+# Начало отсчёта корзин date_bin во всех запросах
+ORIGIN = datetime(2000, 1, 1)
+
+_TIERS = ", ".join(f"({r})" for r in RESOLUTIONS)
+
+# Полный пересчёт агрегатов по сырым показаниям
+BACKFILL = f"""
+    INSERT INTO sensor_rollups
+        (series_id, resolution, bucket, min_value, max_value, sum_value, count, last_timestamp, last_value)
+    SELECT series_id, resolution, bucket, min(value), max(value), sum(value), count(value),
+           max(timestamp), (array_agg(value ORDER BY timestamp DESC, id DESC))[1]
+    FROM (
+        SELECT r.id, r.series_id, t.resolution, r.timestamp, r.value,
+               date_bin(make_interval(secs => t.resolution), r.timestamp, TIMESTAMP '2000-01-01') AS bucket
+        FROM sensor_readings r CROSS JOIN (VALUES {_TIERS}) AS t (resolution)
+        WHERE r.timestamp IS NOT NULL AND r.value IS NOT NULL
+    ) b
+    GROUP BY series_id, resolution, bucket;
+"""
+
+# Пересчёт по сырым показаниям только корзин всех уровней, в которые
+# попадают строки (series_id, timestamp) временной таблицы rollups_stale;
+# остальные агрегаты (в том числе по уже удалённым секциям) не трогаются
+REBUILD_STALE = f"""
+    CREATE TEMP TABLE rollups_touched ON COMMIT DROP AS
+    SELECT DISTINCT s.series_id, t.resolution,
+           date_bin(make_interval(secs => t.resolution), s.timestamp, TIMESTAMP '2000-01-01') AS bucket
+    FROM rollups_stale s CROSS JOIN (VALUES {_TIERS}) AS t (resolution)
+    WHERE s.timestamp IS NOT NULL;
+
+    DELETE FROM sensor_rollups r USING rollups_touched t
+    WHERE r.series_id = t.series_id AND r.resolution = t.resolution AND r.bucket = t.bucket;
+
+    INSERT INTO sensor_rollups
+        (series_id, resolution, bucket, min_value, max_value, sum_value, count, last_timestamp, last_value)
+    SELECT t.series_id, t.resolution, t.bucket, min(r.value), max(r.value), sum(r.value), count(r.value),
+           max(r.timestamp), (array_agg(r.value ORDER BY r.timestamp DESC, r.id DESC))[1]
+    FROM rollups_touched t
+    JOIN sensor_readings r ON r.series_id = t.series_id
+        AND r.timestamp >= t.bucket AND r.timestamp < t.bucket + make_interval(secs => t.resolution)
+    WHERE r.value IS NOT NULL
+    GROUP BY 1, 2, 3;
+"""
+
+SCHEMA = f"""
+    CREATE TABLE sensor_rollups (
+        series_id INTEGER NOT NULL,
+        resolution INTEGER NOT NULL,
+        bucket TIMESTAMP NOT NULL,
+        min_value DOUBLE PRECISION,
+        max_value DOUBLE PRECISION,
+        sum_value DOUBLE PRECISION,
+        count BIGINT NOT NULL,
+        last_timestamp TIMESTAMP,
+        last_value DOUBLE PRECISION,
+        PRIMARY KEY (series_id, resolution, bucket)
+    );
+{BACKFILL}
+    -- Удаляет месячные секции сырых показаний, целиком лежащие до cutoff
+    CREATE FUNCTION sensor_readings_drop_partitions(cutoff TIMESTAMP) RETURNS void AS $$
+    DECLARE
+        part TEXT;
+    BEGIN
+        FOR part IN
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'sensor_readings'::regclass
+              AND c.relname ~ '^sensor_readings_p[0-9]{{6}}$'
+              AND to_date(right(c.relname, 6), 'YYYYMM') + INTERVAL '1 month' <= cutoff
+        LOOP
+            EXECUTE format('DROP TABLE %I', part);
+        END LOOP;
+    END;
+    $$ LANGUAGE plpgsql;
+"""
+
+
+def upsert_rollups(cur, readings):
+    # readings: (series_id, timestamp, value, unit_id). Пачка сворачивается в
+    # корзины всех уровней и сливается с уже накопленными; корзины
+    # обновляются в порядке ключа, чтобы параллельные запросы не взаимоблокировались.
+    if not readings:
+        return
+    execute_values(cur, f"""
+        INSERT INTO sensor_rollups
+            (series_id, resolution, bucket, min_value, max_value, sum_value, count, last_timestamp, last_value)
+        SELECT series_id, resolution, bucket, min(value), max(value), sum(value), count(value),
+               max(timestamp), (array_agg(value ORDER BY timestamp DESC, n DESC))[1]
+        FROM (
+            SELECT r.n, r.series_id, t.resolution, r.timestamp, r.value,
+                   date_bin(make_interval(secs => t.resolution), r.timestamp, TIMESTAMP '2000-01-01') AS bucket
+            FROM (VALUES %s) AS r (n, series_id, timestamp, value)
+            CROSS JOIN (VALUES {_TIERS}) AS t (resolution)
+            WHERE r.timestamp IS NOT NULL AND r.value IS NOT NULL
+        ) b
+        GROUP BY series_id, resolution, bucket
+        ORDER BY series_id, resolution, bucket
+        ON CONFLICT (series_id, resolution, bucket) DO UPDATE SET
+            min_value = LEAST(sensor_rollups.min_value, EXCLUDED.min_value),
+            max_value = GREATEST(sensor_rollups.max_value, EXCLUDED.max_value),
+            sum_value = sensor_rollups.sum_value + EXCLUDED.sum_value,
+            count = sensor_rollups.count + EXCLUDED.count,
+            last_timestamp = GREATEST(sensor_rollups.last_timestamp, EXCLUDED.last_timestamp),
+            last_value = CASE WHEN EXCLUDED.last_timestamp >= sensor_rollups.last_timestamp
+                              THEN EXCLUDED.last_value ELSE sensor_rollups.last_value END
+    """, [(n, series_id, ts, value) for n, (series_id, ts, value, _) in enumerate(readings)],
+        template="(%s, %s::integer, %s::timestamp, %s::double precision)",
+        page_size=len(readings))
+
+
+def pick_resolution(start, end, points):
+    # Самый грубый уровень, который ещё даёт не меньше points корзин на
+    # [start, end]; None — диапазон слишком короткий, читать сырые показания
+    span = (end - start).total_seconds()
+    for resolution in reversed(RESOLUTIONS):
+        if span / resolution >= points:
+            return resolution
+    return None
+
+
+def series_id(cur, telegram_id, sensor, parameter):
+    cur.execute("SELECT id FROM sensor_series WHERE telegram_id = %s AND sensor = %s AND parameter = %s",
+                (telegram_id, sensor, parameter))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def window_start(cur, series_id, count):
+    # Начало корзины WINDOW_RESOLUTION, с которой начинаются последние count
+    # показаний ряда (или самой ранней, если показаний меньше)
+    cur.execute("""
+        SELECT bucket FROM (
+            SELECT bucket, sum(count) OVER (ORDER BY bucket DESC) AS total
+            FROM sensor_rollups
+            WHERE series_id = %s AND resolution = %s
+            ORDER BY bucket DESC
+        ) w
+        WHERE total >= %s
+        LIMIT 1
+    """, (series_id, WINDOW_RESOLUTION, count))
+    row = cur.fetchone()
+    if row is None:
+        cur.execute("SELECT min(bucket) FROM sensor_rollups WHERE series_id = %s AND resolution = %s",
+                    (series_id, WINDOW_RESOLUTION))
+        row = cur.fetchone()
+    return row[0]
+
+
+def read_rollups(cur, series_id, resolution, start, end, points):
+    # (bucket, min, max) уровня resolution на [start, end], дополнительно
+    # сведённые не более чем в points групп
+    cur.execute("""
+        SELECT min(bucket), min(min_value), max(max_value)
+        FROM (
+            SELECT bucket, min_value, max_value, ntile(%s) OVER (ORDER BY bucket) AS g
+            FROM sensor_rollups
+            WHERE series_id = %s AND resolution = %s AND bucket >= %s AND bucket <= %s
+        ) t
+        GROUP BY g
+        ORDER BY 1
+    """, (points, series_id, resolution, start, end))
+    return cur.fetchall()
+
+
+def aligned_resolution(start, end, bucket):
+    # Самый грубый уровень, корзины которого целиком лежат внутри корзин
+    # bucket и внутри [start, end); None — такого нет, нужны сырые показания
+    for resolution in reversed(RESOLUTIONS):
+        if bucket % resolution == 0 and all(
+                (ts - ORIGIN).total_seconds() % resolution == 0 for ts in (start, end)):
+            return resolution
+    return None
+
+
+def aggregate(cur, series_ids, start, end, bucket, percentiles=()):
+    """Агрегаты показаний рядов по корзинам bucket секунд на [start, end).
+
+    Возвращает (источник, строки (series_id, корзина, min, max, avg, count[, [перцентили]])),
+    строки по рядам и времени, пустые корзины пропускаются. Без перцентилей
+    и при выровненных границах считается по sensor_rollups (объём чтения —
+    по числу корзин уровня), иначе — date_bin по сырым показаниям в БД.
+    """
+    resolution = None if percentiles else aligned_resolution(start, end, bucket)
+    if resolution:
+        cur.execute("""
+            SELECT series_id, date_bin(make_interval(secs => %s), bucket, %s) AS b,
+                   min(min_value), max(max_value), sum(sum_value) / NULLIF(sum(count), 0), sum(count)::bigint
+            FROM sensor_rollups
+            WHERE series_id = ANY(%s) AND resolution = %s AND bucket >= %s AND bucket < %s
+            GROUP BY 1, 2
+            ORDER BY 1, 2
+        """, (bucket, ORIGIN, list(series_ids), resolution, start, end))
+        return "rollups", cur.fetchall()
+
+    quantiles = ", percentile_cont(%s::float8[]) WITHIN GROUP (ORDER BY value)" if percentiles else ""
+    params = [bucket, ORIGIN] + ([list(percentiles)] if percentiles else []) + [list(series_ids), start, end]
+    cur.execute(f"""
+        SELECT series_id, date_bin(make_interval(secs => %s), timestamp, %s) AS b,
+               min(value), max(value), avg(value), count(value){quantiles}
+        FROM sensor_readings
+        WHERE series_id = ANY(%s) AND timestamp >= %s AND timestamp < %s AND value IS NOT NULL
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+    """, params)
+    return "raw", cur.fetchall()
@@ -0,0 +1,333 @@
+"""Общая схема БД для api, analyzer и telegram_bot.
+
+Показания лежат в секционированной по месяцам таблице sensor_readings,
+строки датчика/параметра/единицы вынесены в справочники sensor_series и
+units. sensor_data_ext сохранён как представление с прежними столбцами,
+поэтому запросы на чтение менять не нужно. Последнее показание каждого
+ряда хранится в sensor_latest и обновляется при записи (см.
+core.storage.insert_readings), там же пополняются агрегаты
+sensor_rollups (см. core.rollups). Показание ряда на один момент времени
+хранится один раз: повторная отправка той же пачки ничего не добавляет. Миграции версионированы в
+schema_migrations и выполняются под advisory-блокировкой, так что
+одновременный старт сервисов безопасен. Сами сервисы схему не меняют,
+а только проверяют её версию (check_schema); миграции — отдельный шаг
+перед их запуском:
+
+    python -m core.schema
+"""
+
+from core import alert_state, rollups
+
+SCHEMA_LOCK_ID = 7_202_501
+READINGS_CHANNEL = 'sensor_readings_inserted'
+SERIES_CHANNEL = 'sensor_series_added'
+
+BASE = """
+    CREATE TABLE IF NOT EXISTS users (
+        id SERIAL PRIMARY KEY,
+        telegram_id BIGINT UNIQUE,
+        full_name TEXT,
+        username TEXT,
+        role TEXT,
+        registered_at TIMESTAMP DEFAULT NOW()
+    );
+
+    CREATE TABLE IF NOT EXISTS alert_thresholds (
+        id SERIAL PRIMARY KEY,
+        telegram_id BIGINT,
+        sensor TEXT,
+        parameter TEXT,
+        lower DOUBLE PRECISION,
+        upper DOUBLE PRECISION
+    );
+
+    CREATE TABLE IF NOT EXISTS parameter_thresholds (
+        id SERIAL PRIMARY KEY,
+        telegram_id BIGINT,
+        sensor TEXT,
+        parameter TEXT,
+        lower_bound DOUBLE PRECISION,
+        upper_bound DOUBLE PRECISION
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS parameter_thresholds_key
+        ON parameter_thresholds (telegram_id, sensor, parameter);
+
+    CREATE OR REPLACE FUNCTION notify_thresholds_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('thresholds_changed', '');
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE TRIGGER alert_thresholds_notify
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON alert_thresholds
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_thresholds_changed();
+    CREATE OR REPLACE TRIGGER parameter_thresholds_notify
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON parameter_thresholds
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_thresholds_changed();
+"""
+
+TIMESERIES = """
+    CREATE TABLE units (
+        id SERIAL PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    );
+
+    CREATE TABLE sensor_series (
+        id SERIAL PRIMARY KEY,
+        telegram_id BIGINT NOT NULL,
+        sensor TEXT NOT NULL,
+        parameter TEXT NOT NULL,
+        UNIQUE (telegram_id, sensor, parameter)
+    );
+
+    -- Без первичного ключа: он обязан включать timestamp, а устройства
+    -- могут прислать запись без времени (она попадёт в секцию default)
+    CREATE TABLE sensor_readings (
+        id BIGSERIAL,
+        series_id INTEGER NOT NULL,
+        timestamp TIMESTAMP,
+        value DOUBLE PRECISION,
+        unit_id INTEGER
+    ) PARTITION BY RANGE (timestamp);
+    CREATE TABLE sensor_readings_default PARTITION OF sensor_readings DEFAULT;
+    CREATE INDEX sensor_readings_series_ts ON sensor_readings (series_id, timestamp DESC);
+    CREATE INDEX sensor_readings_id ON sensor_readings (id);
+
+    CREATE FUNCTION sensor_readings_create_partition(month_start DATE) RETURNS void AS $$
+    DECLARE
+        part TEXT := format('sensor_readings_p%s', to_char(month_start, 'YYYYMM'));
+        month_end DATE := (month_start + INTERVAL '1 month')::date;
+    BEGIN
+        IF to_regclass(part) IS NOT NULL THEN
+            RETURN;
+        END IF;
+        -- Строки этого месяца, уже попавшие в default, переносятся в новую секцию
+        EXECUTE format('CREATE TABLE %I (LIKE sensor_readings INCLUDING DEFAULTS)', part);
+        EXECUTE format(
+            'WITH moved AS (DELETE FROM sensor_readings_default WHERE timestamp >= %L AND timestamp < %L RETURNING *)
+             INSERT INTO %I SELECT * FROM moved', month_start, month_end, part);
+        EXECUTE format('ALTER TABLE sensor_readings ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                       part, month_start, month_end);
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE FUNCTION sensor_readings_maintain_partitions(months_ahead INTEGER DEFAULT 2) RETURNS void AS $$
+    DECLARE
+        m DATE;
+    BEGIN
+        FOR m IN
+            SELECT generate_series(date_trunc('month', now()) - INTERVAL '1 month',
+                                   date_trunc('month', now()) + make_interval(months => months_ahead),
+                                   INTERVAL '1 month')::date
+            UNION
+            SELECT DISTINCT date_trunc('month', timestamp)::date
+            FROM sensor_readings_default WHERE timestamp IS NOT NULL
+        LOOP
+            PERFORM sensor_readings_create_partition(m);
+        END LOOP;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    -- Перенос данных из старой плоской таблицы с сохранением id
+    DO $$
+    BEGIN
+        IF to_regclass('sensor_data_ext') IS NULL THEN
+            RETURN;
+        END IF;
+        ALTER TABLE sensor_data_ext RENAME TO sensor_data_ext_legacy;
+
+        INSERT INTO units (name)
+        SELECT DISTINCT unit FROM sensor_data_ext_legacy WHERE unit IS NOT NULL;
+        INSERT INTO sensor_series (telegram_id, sensor, parameter)
+        SELECT DISTINCT telegram_id, sensor, parameter FROM sensor_data_ext_legacy
+        WHERE telegram_id IS NOT NULL AND sensor IS NOT NULL AND parameter IS NOT NULL;
+
+        PERFORM sensor_readings_create_partition(m)
+        FROM (SELECT DISTINCT date_trunc('month', timestamp)::date AS m
+              FROM sensor_data_ext_legacy WHERE timestamp IS NOT NULL) months;
+
+        INSERT INTO sensor_readings (id, series_id, timestamp, value, unit_id)
+        SELECT d.id, s.id, d.timestamp, d.value, u.id
+        FROM sensor_data_ext_legacy d
+        JOIN sensor_series s USING (telegram_id, sensor, parameter)
+        LEFT JOIN units u ON u.name = d.unit;
+
+        PERFORM setval('sensor_readings_id_seq', max(id)) FROM sensor_readings HAVING max(id) IS NOT NULL;
+        DROP TABLE sensor_data_ext_legacy;
+    END;
+    $$;
+
+    CREATE VIEW sensor_data_ext AS
+    SELECT r.id, s.telegram_id, r.timestamp, s.sensor, s.parameter, r.value, u.name AS unit
+    FROM sensor_readings r
+    JOIN sensor_series s ON s.id = r.series_id
+    LEFT JOIN units u ON u.id = r.unit_id;
+"""
+
+LATEST = """
+    CREATE TABLE sensor_latest (
+        series_id INTEGER PRIMARY KEY,
+        timestamp TIMESTAMP,
+        value DOUBLE PRECISION,
+        unit_id INTEGER
+    );
+
+    INSERT INTO sensor_latest (series_id, timestamp, value, unit_id)
+    SELECT DISTINCT ON (series_id) series_id, timestamp, value, unit_id
+    FROM sensor_readings
+    ORDER BY series_id, timestamp DESC NULLS LAST, id DESC;
+
+    CREATE VIEW sensor_latest_ext AS
+    SELECT s.telegram_id, s.sensor, s.parameter, l.timestamp, l.value, u.name AS unit
+    FROM sensor_latest l
+    JOIN sensor_series s ON s.id = l.series_id
+    LEFT JOIN units u ON u.id = l.unit_id;
+"""
+
+INGEST_LOG = """
+    -- Сегменты журнала отложенной записи API, уже сброшенные в БД
+    CREATE TABLE ingest_segments (
+        name TEXT PRIMARY KEY,
+        flushed_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+"""
+
+ANALYZER = """
+    -- Курсоры потребителей sensor_readings по id
+    CREATE TABLE analyzer_checkpoints (
+        name TEXT PRIMARY KEY,
+        last_id BIGINT NOT NULL,
+        updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+
+    -- Одно уведомление на транзакцию с вставкой, доставляется при коммите
+    CREATE FUNCTION notify_readings_inserted() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('sensor_readings_inserted', '');
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER sensor_readings_notify
+        AFTER INSERT ON sensor_readings
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_readings_inserted();
+"""
+
+DETECTOR = """
+    -- Сохранённое состояние потокового детектора по рядам
+    CREATE TABLE detector_state (
+        telegram_id BIGINT NOT NULL,
+        sensor TEXT NOT NULL,
+        parameter TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        n BIGINT NOT NULL,
+        mean DOUBLE PRECISION NOT NULL,
+        var DOUBLE PRECISION NOT NULL,
+        updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (telegram_id, sensor, parameter)
+    );
+"""
+
+SERIES_NOTIFY = """
+    -- Первое показание нового ряда (вставка, а не обновление sensor_latest):
+    -- telegram_id владельца, доставляется при коммите записи показаний
+    CREATE FUNCTION notify_series_added() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('sensor_series_added', telegram_id::text)
+        FROM sensor_series WHERE id = NEW.series_id;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER sensor_latest_added
+        AFTER INSERT ON sensor_latest
+        FOR EACH ROW EXECUTE FUNCTION notify_series_added();
+"""
+
+DEDUPLICATE = f"""
+    -- Повторно присланные показания (ретраи устройств) удаляются, агрегаты
+    -- задетых корзин пересчитываются; дальше повтор отсекает уникальный
+    -- индекс (ON CONFLICT DO NOTHING в core.storage.insert_readings).
+    -- Он же заменяет прежний неуникальный индекс по (series_id, timestamp DESC).
+    CREATE TEMP TABLE rollups_stale ON COMMIT DROP AS
+    WITH removed AS (
+        DELETE FROM sensor_readings a USING sensor_readings b
+        WHERE a.series_id = b.series_id AND a.timestamp = b.timestamp AND a.id > b.id
+        RETURNING a.series_id, a.timestamp
+    )
+    SELECT DISTINCT series_id, timestamp FROM removed;
+{rollups.REBUILD_STALE}
+    CREATE UNIQUE INDEX sensor_readings_series_ts_key ON sensor_readings (series_id, timestamp);
+    DROP INDEX sensor_readings_series_ts;
+"""
+
+MIGRATIONS = [
+    (1, BASE),
+    (2, TIMESERIES),
+    (3, LATEST),
+    (4, rollups.SCHEMA),
+    (5, INGEST_LOG),
+    (6, ANALYZER),
+    (7, DETECTOR),
+    (8, alert_state.SCHEMA),
+    (9, SERIES_NOTIFY),
+    (10, DEDUPLICATE),
+]
+
+
+def migrate(conn):
+    # Выполняется одной транзакцией на соединении без autocommit
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                applied_at TIMESTAMP DEFAULT NOW()
+            );
+        """)
+        cur.execute("SELECT version FROM schema_migrations")
+        applied = {version for version, in cur.fetchall()}
+        for version, sql in MIGRATIONS:
+            if version in applied:
+                continue
+            cur.execute(sql)
+            cur.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (version,))
+            print(f"Схема БД: применена миграция {version}")
+    conn.commit()
+    maintain_partitions(conn)
+
+
+def check_schema(conn):
+    # RuntimeError, если миграции ещё не применены; более новая схема допустима
+    latest = MIGRATIONS[-1][0]
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+        version = None
+        if cur.fetchone()[0]:
+            cur.execute("SELECT max(version) FROM schema_migrations")
+            version = cur.fetchone()[0]
+    conn.rollback()
+    if version is None or version < latest:
+        raise RuntimeError(f"Схема БД версии {version}, нужна {latest}: выполните python -m core.schema")
+
+
+def maintain_partitions(conn, months_ahead=2, retention_days=None):
+    # Создаёт секции на ближайшие месяцы и разбирает накопившееся в default;
+    # при retention_days удаляет секции сырых показаний старше этого срока
+    # (агрегаты sensor_rollups остаются)
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
+        cur.execute("SELECT sensor_readings_maintain_partitions(%s)", (months_ahead,))
+        if retention_days:
+            cur.execute("SELECT sensor_readings_drop_partitions((now() - make_interval(days => %s))::timestamp)",
+                        (retention_days,))
+    conn.commit()
+
+
+if __name__ == "__main__":
+    from core.db import connect
+
+    conn = connect()
+    migrate(conn)
+    conn.close()
@@ -0,0 +1,101 @@
+import threading
+
+from psycopg2.extras import execute_values
+
+from core.rollups import upsert_rollups
+
+
+class SeriesCatalog:
+    """Кэш идентификаторов справочников sensor_series и units.
+
+    Новые ряды и единицы заводятся отдельной короткой транзакцией до
+    записи показаний, поэтому в кэш попадают только закоммиченные id.
+    connection — фабрика контекстных менеджеров соединения (Database.connection).
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._series = {}
+        self._units = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, rows):
+        # rows: (telegram_id, timestamp, sensor, parameter, value, unit)
+        series = {(int(r[0]), r[2], r[3]) for r in rows} - self._series.keys()
+        units = {r[5] for r in rows if r[5] is not None} - self._units.keys()
+        if not series and not units:
+            return []
+        with self._lock, self._connection() as conn, conn.cursor() as cur:
+            new_series = sorted(series - self._series.keys())
+            if new_series:
+                execute_values(cur, """
+                    INSERT INTO sensor_series (telegram_id, sensor, parameter) VALUES %s
+                    ON CONFLICT DO NOTHING
+                """, new_series)
+                found = execute_values(cur, """
+                    SELECT s.id, s.telegram_id, s.sensor, s.parameter
+                    FROM sensor_series s JOIN (VALUES %s) AS k (telegram_id, sensor, parameter)
+                    USING (telegram_id, sensor, parameter)
+                """, new_series, template="(%s::bigint, %s, %s)", fetch=True)
+                self._series.update({(tg_id, s, p): series_id for series_id, tg_id, s, p in found})
+            new_units = sorted(units - self._units.keys())
+            if new_units:
+                execute_values(cur, "INSERT INTO units (name) VALUES %s ON CONFLICT DO NOTHING",
+                               [(u,) for u in new_units])
+                cur.execute("SELECT id, name FROM units WHERE name = ANY(%s)", (new_units,))
+                self._units.update({name: unit_id for unit_id, name in cur.fetchall()})
+        return new_series
+
+    def series_id(self, telegram_id, sensor, parameter):
+        return self._series[(int(telegram_id), sensor, parameter)]
+
+    def unit_id(self, unit):
+        return None if unit is None else self._units[unit]
+
+
+def insert_readings(conn, catalog, rows, page_size=5000):
+    # Ряды и единицы должны быть заранее заведены через catalog.resolve(rows);
+    # в той же транзакции обновляются sensor_latest и sensor_rollups.
+    # Уже сохранённые показания (тот же ряд и момент) пропускаются и в
+    # агрегаты не попадают; возвращает множество ключей (series_id, timestamp)
+    # действительно вставленных показаний.
+    # xid транзакции назначается до первого nextval: по нему analyzer
+    # понимает, что все строки с меньшими id уже зафиксированы
+    readings = [
+        (catalog.series_id(tg_id, s, p), ts, v, catalog.unit_id(u))
+        for tg_id, ts, s, p, v, u in rows
+    ]
+    inserted = set()
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_current_xact_id()")
+        for start in range(0, len(readings), page_size):
+            page = execute_values(cur, """
+                INSERT INTO sensor_readings (series_id, timestamp, value, unit_id)
+                VALUES %s
+                ON CONFLICT DO NOTHING
+                RETURNING series_id, timestamp, value, unit_id
+            """, readings[start:start + page_size], page_size=page_size, fetch=True)
+            upsert_latest(cur, page)
+            upsert_rollups(cur, page)
+            inserted.update((series_id, ts) for series_id, ts, _, _ in page)
+    return inserted
+
+
+def upsert_latest(cur, readings):
+    # readings: (series_id, timestamp, value, unit_id). Из пачки берётся
+    # самое свежее показание ряда (при равном времени — последнее), и оно
+    # заменяет сохранённое, только если не старше его. Ряды обновляются в
+    # порядке series_id, чтобы параллельные запросы не взаимоблокировались.
+    if not readings:
+        return
+    execute_values(cur, """
+        INSERT INTO sensor_latest (series_id, timestamp, value, unit_id)
+        SELECT DISTINCT ON (series_id) series_id, timestamp, value, unit_id
+        FROM (VALUES %s) AS r (n, series_id, timestamp, value, unit_id)
+        ORDER BY series_id, timestamp DESC NULLS LAST, n DESC
+        ON CONFLICT (series_id) DO UPDATE
+        SET timestamp = EXCLUDED.timestamp, value = EXCLUDED.value, unit_id = EXCLUDED.unit_id
+        WHERE sensor_latest.timestamp IS NULL OR EXCLUDED.timestamp >= sensor_latest.timestamp
+    """, [(n,) + r for n, r in enumerate(readings)],
+        template="(%s, %s::integer, %s::timestamp, %s::double precision, %s::integer)",
+        page_size=len(readings))
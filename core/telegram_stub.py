@@ -0,0 +1,73 @@
+"""Локальная заглушка Bot API для проверки отправки предупреждений без сети.
+
+    python -m core.telegram_stub --port 8081
+    TELEGRAM_API_URL=http://localhost:8081 python app.py
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class TelegramStub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, fail_every=0, verbose=False):
+        super().__init__(address, _Handler)
+        self.fail_every = fail_every
+        self.verbose = verbose
+        self.messages = []
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server = self.server
+        with server._lock:
+            server.requests += 1
+            # Каждый fail_every-й запрос получает 429, как при превышении лимита
+            throttled = server.fail_every and server.requests % server.fail_every == 0
+            if not throttled and self.path.endswith("/sendMessage"):
+                message = json.loads(body or b"{}")
+                message["received_at"] = time.time()
+                server.messages.append(message)
+        if throttled:
+            self._reply(429, {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                              "parameters": {"retry_after": 1}})
+            return
+        if server.verbose:
+            print(self.path, body.decode("utf-8", "replace"))
+        self._reply(200, {"ok": True, "result": {"message_id": server.requests}})
+
+    def _reply(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--fail-every", type=int, default=0)
+    args = parser.parse_args()
+    TelegramStub((args.host, args.port), fail_every=args.fail_every, verbose=True).serve_forever()
@@ -1,19 +1,25 @@
 import asyncio
 import os
-import psycopg2
-import pandas as pd
-import matplotlib.pyplot as plt
-from datetime import datetime
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
-from aiogram.filters import Command
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile, FSInputFile
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import StatesGroup, State
 
+from core import metrics
+from core.db import Database
+from core.schema import check_schema
+from charts import BUCKETS, PlotCache, render_plot
+from repository import Repository
+
 class ParamSelect(StatesGroup):
     telegram_id = State()
     sensor = State()
@@ -28,15 +34,39 @@ class ThresholdSet(StatesGroup):
 
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-DB_HOST = os.getenv("DB_HOST")
-DB_NAME = os.getenv("DB_NAME")
-DB_USER = os.getenv("DB_USER")
-DB_PASSWORD = os.getenv("DB_PASSWORD")
+PLOT_WORKERS = int(os.getenv("PLOT_WORKERS", "2"))
+PLOT_CACHE_SIZE = int(os.getenv("PLOT_CACHE_SIZE", "128"))
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "9100"))
+BOT_CACHE_SIZE = int(os.getenv("BOT_CACHE_SIZE", "1024"))
+BOT_CACHE_TTL = float(os.getenv("BOT_CACHE_TTL", "60"))
+EXPORT_DAYS = int(os.getenv("EXPORT_DAYS", "30"))
+# Ограничение Bot API на отправку файлов
+TELEGRAM_FILE_LIMIT = 50 << 20
+
+HANDLER_SECONDS = metrics.Histogram("bot_handler_seconds", "Время обработки апдейта", ["handler"])
+HANDLER_ERRORS = metrics.Counter("bot_handler_errors_total", "Обработчики, завершившиеся исключением", ["handler"])
 
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher(storage=MemoryStorage())
 
-conn = None
+repo = None
+plot_executor = ThreadPoolExecutor(max_workers=PLOT_WORKERS, thread_name_prefix="plot")
+plot_cache = PlotCache(size=PLOT_CACHE_SIZE)
+
+async def timed(handler, event, data):
+    # Внутренний middleware: вызывается после фильтров, так что обработчик известен
+    name = data["handler"].callback.__name__
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        HANDLER_ERRORS.labels(name).inc()
+        raise
+    finally:
+        HANDLER_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+dp.message.middleware(timed)
+dp.callback_query.middleware(timed)
 
 def get_main_kb(is_admin=False):
     keyboard = [
@@ -51,52 +81,57 @@ def get_main_kb(is_admin=False):
 
 @dp.message(F.text == "⚠️ Настроить предупреждения")
 async def setup_threshold_start(msg: types.Message, state: FSMContext):
-    with conn.cursor() as cur:
-        cur.execute("SELECT DISTINCT sensor FROM sensor_data_ext WHERE telegram_id = %s", (msg.from_user.id,))
-        sensors = cur.fetchall()
+    sensors = await repo.sensors(msg.from_user.id)
     if not sensors:
         await msg.answer("Нет данных.")
         return
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=s[0], callback_data=f"thr_sensor:{s[0]}")] for s in sensors
+        [InlineKeyboardButton(text=s, callback_data=f"thr_sensor:{s}")] for s in sensors
     ])
     await msg.answer("Выберите датчик:", reply_markup=kb)
 
 
 @dp.message(Command("start"))
 async def start_cmd(msg: types.Message):
-    global conn
     user_id = msg.from_user.id
     username = msg.from_user.username or ""
     full_name = msg.from_user.full_name or ""
 
-    with conn.cursor() as cur:
-        cur.execute("SELECT * FROM users WHERE telegram_id = %s", (user_id,))
-        user = cur.fetchone()
-        if not user:
-            cur.execute("""
-                INSERT INTO users (telegram_id, full_name, username, role)
-                VALUES (%s, %s, %s, %s)
-            """, (user_id, full_name, username, 'operator'))
-            role = 'operator'
-        else:
-            role = user[4]
+    role = await repo.register_user(user_id, full_name, username)
 
     await msg.answer("👋 Добро пожаловать!", reply_markup=get_main_kb(is_admin=(role == 'admin')))
 
+@dp.message(Command("export"))
+async def export_cmd(msg: types.Message, command: CommandObject):
+    # /export [датчик] [параметр] [дней] — свои показания файлом CSV (gzip)
+    args = (command.args or "").split()
+    days = int(args.pop()) if args and args[-1].isdigit() else EXPORT_DAYS
+    sensor = args[0] if args else None
+    parameter = args[1] if len(args) > 1 else None
+
+    fd, path = tempfile.mkstemp(suffix=".csv.gz")
+    os.close(fd)
+    try:
+        rows = await repo.export_csv(path, msg.from_user.id, sensor, parameter,
+                                     datetime.utcnow() - timedelta(days=days), limit=TELEGRAM_FILE_LIMIT)
+        if rows is None or os.path.getsize(path) > TELEGRAM_FILE_LIMIT:
+            await msg.answer("Выгрузка больше 50 МБ: сузьте период или используйте /api/v1/export.")
+        elif not rows:
+            await msg.answer("Нет данных.")
+        else:
+            await msg.answer_document(FSInputFile(path, filename=f"sensors-{days}d.csv.gz"),
+                                      caption=f"Строк: {rows}")
+    finally:
+        os.remove(path)
+
 async def get_user_role(user_id):
-    with conn.cursor() as cur:
-        cur.execute("SELECT role FROM users WHERE telegram_id = %s", (user_id,))
-        row = cur.fetchone()
-    return row[0] if row else 'operator'
+    return await repo.user_role(user_id)
 
 @dp.message(F.text == "🔎 Статус")
 async def status_command(msg: types.Message, state: FSMContext):
     role = await get_user_role(msg.from_user.id)
     if role == 'admin':
-        with conn.cursor() as cur:
-            cur.execute("SELECT DISTINCT telegram_id, username FROM users")
-            users = cur.fetchall()
+        users = await repo.users()
         kb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text=f"@{u[1]}", callback_data=f"admin_status:{u[0]}")] for u in users if u[1]
         ])
@@ -110,40 +145,26 @@ async def admin_select_status(callback: types.CallbackQuery):
     await show_sensors_status(telegram_id, callback.message)
 
 async def show_sensors_status(telegram_id, message):
-    with conn.cursor() as cur:
-        cur.execute("SELECT DISTINCT sensor FROM sensor_data_ext WHERE telegram_id = %s", (telegram_id,))
-        sensors = cur.fetchall()
+    sensors = await repo.sensors(telegram_id)
     if not sensors:
         await message.answer("Нет данных.")
         return
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=s[0], callback_data=f"status:{telegram_id}:{s[0]}")] for s in sensors
+        [InlineKeyboardButton(text=s, callback_data=f"status:{telegram_id}:{s}")] for s in sensors
     ])
     await message.answer("Выберите датчик:", reply_markup=kb)
 
 @dp.callback_query(F.data.startswith("status:"))
 async def show_status_for_sensor(callback: types.CallbackQuery):
     _, telegram_id, sensor = callback.data.split(":")
-    with conn.cursor() as cur:
-        cur.execute("""
-            SELECT parameter, value, unit, timestamp
-            FROM sensor_data_ext
-            WHERE sensor = %s AND telegram_id = %s
-            ORDER BY timestamp DESC
-        """, (sensor, telegram_id))
-        rows = cur.fetchall()
-
-    result = {}
-    for param, value, unit, ts in rows:
-        if param not in result:
-            result[param] = (value, unit, ts)
-
-    if not result:
+    rows = await repo.latest(int(telegram_id), sensor)
+
+    if not rows:
         await callback.message.answer("Нет данных.")
         return
 
     text = f"📟 <b>{sensor}</b>:\n"
-    for param, (val, unit, ts) in result.items():
+    for param, val, unit in rows:
         text += f"{param} = {val} {unit}\n"
     await callback.message.answer(text)
 
@@ -151,9 +172,7 @@ async def show_status_for_sensor(callback: types.CallbackQuery):
 async def last_values_command(msg: types.Message, state: FSMContext):
     role = await get_user_role(msg.from_user.id)
     if role == 'admin':
-        with conn.cursor() as cur:
-            cur.execute("SELECT telegram_id, username FROM users")
-            users = cur.fetchall()
+        users = await repo.users()
         kb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text=f"@{u[1]}", callback_data=f"admin_data:{u[0]}")] for u in users if u[1]
         ])
@@ -168,23 +187,20 @@ async def admin_choose_user_data(callback: types.CallbackQuery, state: FSMContex
     await show_sensor_selection(telegram_id, callback.message, state)
 
 async def show_sensor_selection(telegram_id, message, state):
-    with conn.cursor() as cur:
-        cur.execute("SELECT DISTINCT sensor FROM sensor_data_ext WHERE telegram_id = %s", (telegram_id,))
-        sensors = cur.fetchall()
+    sensors = await repo.sensors(telegram_id)
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=s[0], callback_data=f"param_sensor:{telegram_id}:{s[0]}")] for s in sensors
+        [InlineKeyboardButton(text=s, callback_data=f"param_sensor:{telegram_id}:{s}")] for s in sensors
     ])
     await message.answer("Выберите датчик:", reply_markup=kb)
 
 @dp.callback_query(F.data.startswith("param_sensor:"))
 async def choose_param(callback: types.CallbackQuery, state: FSMContext):
     _, telegram_id, sensor = callback.data.split(":")
-    await state.update_data(sensor=sensor, telegram_id=int(telegram_id))
-    with conn.cursor() as cur:
-        cur.execute("SELECT DISTINCT parameter FROM sensor_data_ext WHERE sensor = %s AND telegram_id = %s", (sensor, telegram_id))
-        params = cur.fetchall()
+    telegram_id = int(telegram_id)
+    await state.update_data(sensor=sensor, telegram_id=telegram_id)
+    params = await repo.parameters(telegram_id, sensor)
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=p[0], callback_data=f"param_select:{p[0]}")] for p in params
+        [InlineKeyboardButton(text=p, callback_data=f"param_select:{p}")] for p in params
     ])
     await callback.message.answer("Выберите параметр:", reply_markup=kb)
 
@@ -199,11 +215,9 @@ async def ask_count(callback: types.CallbackQuery, state: FSMContext):
 async def threshold_choose_sensor(callback: types.CallbackQuery, state: FSMContext):
     sensor = callback.data.split(":")[1]
     await state.update_data(sensor=sensor)
-    with conn.cursor() as cur:
-        cur.execute("SELECT DISTINCT parameter FROM sensor_data_ext WHERE sensor = %s AND telegram_id = %s", (sensor, callback.from_user.id))
-        params = cur.fetchall()
+    params = await repo.parameters(callback.from_user.id, sensor)
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=p[0], callback_data=f"thr_param:{p[0]}")] for p in params
+        [InlineKeyboardButton(text=p, callback_data=f"thr_param:{p}")] for p in params
     ])
     await callback.message.answer("Выберите параметр:", reply_markup=kb)
 
@@ -233,23 +247,7 @@ async def threshold_set_upper(msg: types.Message, state: FSMContext):
         await msg.answer("Введите число.")
         return
     data = await state.get_data()
-    with conn.cursor() as cur:
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS parameter_thresholds (
-                id SERIAL PRIMARY KEY,
-                telegram_id BIGINT,
-                sensor TEXT,
-                parameter TEXT,
-                lower_bound DOUBLE PRECISION,
-                upper_bound DOUBLE PRECISION
-            );
-        """)
-        cur.execute("""
-            INSERT INTO parameter_thresholds (telegram_id, sensor, parameter, lower_bound, upper_bound)
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT (telegram_id, sensor, parameter)
-            DO UPDATE SET lower_bound = EXCLUDED.lower_bound, upper_bound = EXCLUDED.upper_bound
-        """, (msg.from_user.id, data["sensor"], data["parameter"], data["lower"], upper))
+    await repo.set_threshold(msg.from_user.id, data["sensor"], data["parameter"], data["lower"], upper)
     await msg.answer("✅ Порог установлен.")
     await state.clear()
 
@@ -259,6 +257,8 @@ async def show_plot(msg: types.Message, state: FSMContext):
     try:
         count = int(msg.text)
     except ValueError:
+        count = 0
+    if count < 1:
         await msg.answer("Введите число")
         return
 
@@ -267,30 +267,19 @@ async def show_plot(msg: types.Message, state: FSMContext):
     sensor = data["sensor"]
     parameter = data["parameter"]
 
-    with conn.cursor() as cur:
-        cur.execute("""
-            SELECT timestamp, value FROM sensor_data_ext
-            WHERE telegram_id = %s AND sensor = %s AND parameter = %s
-            ORDER BY timestamp DESC LIMIT %s
-        """, (telegram_id, sensor, parameter, count))
-        rows = cur.fetchall()
-
-    if not rows:
-        await msg.answer("Нет данных.")
-        return
-
-    df = pd.DataFrame(rows, columns=["timestamp", "value"]).sort_values("timestamp")
-    plt.figure(figsize=(8, 4))
-    plt.plot(df["timestamp"], df["value"], marker="o")
-    plt.title(f"{sensor}.{parameter}")
-    plt.grid(True)
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.savefig("plot.png")
-    plt.close()
-
-    photo = FSInputFile("plot.png")
-    await msg.answer_photo(photo)
+    latest_ts = await repo.latest_timestamp(telegram_id, sensor, parameter)
+    key = (telegram_id, sensor, parameter, count, latest_ts)
+    png = plot_cache.get(key)
+    if png is None:
+        rows = await repo.history(telegram_id, sensor, parameter, count, BUCKETS)
+        if not rows:
+            await msg.answer("Нет данных.")
+            return
+        loop = asyncio.get_running_loop()
+        png = await loop.run_in_executor(plot_executor, render_plot, f"{sensor}.{parameter}", rows)
+        plot_cache.put(key, png)
+
+    await msg.answer_photo(BufferedInputFile(png, filename="plot.png"))
     await state.clear()
 
 # 👥 Пользователи
@@ -301,9 +290,7 @@ async def show_users(msg: types.Message):
         await msg.answer("⛔ Доступ запрещён.")
         return
 
-    with conn.cursor() as cur:
-        cur.execute("SELECT full_name, username, role, registered_at FROM users")
-        rows = cur.fetchall()
+    rows = await repo.users_info()
 
     text = "👥 <b>Пользователи:</b>\n"
     for name, username, role, reg in rows:
@@ -318,9 +305,7 @@ async def promote_user_list(msg: types.Message):
         await msg.answer("⛔ Доступ запрещён.")
         return
 
-    with conn.cursor() as cur:
-        cur.execute("SELECT telegram_id, username FROM users WHERE role = 'operator'")
-        ops = cur.fetchall()
+    ops = await repo.users_with_role('operator')
 
     if not ops:
         await msg.answer("Нет операторов для повышения.")
@@ -335,9 +320,7 @@ async def promote_user_list(msg: types.Message):
 @dp.message(F.text == "🔄 Понизить")
 async def demote_user_list(msg: types.Message):
     admin_id = msg.from_user.id
-    with conn.cursor() as cur:
-        cur.execute("SELECT telegram_id, username FROM users WHERE role = 'admin' AND telegram_id != %s", (admin_id,))
-        admins = cur.fetchall()
+    admins = await repo.users_with_role('admin', exclude=admin_id)
 
     if not admins:
         await msg.answer("Нет других администраторов для понижения.")
@@ -351,39 +334,27 @@ async def demote_user_list(msg: types.Message):
 @dp.callback_query(F.data.startswith("promote:"))
 async def promote_user(callback: types.CallbackQuery):
     uid = int(callback.data.split(":")[1])
-    with conn.cursor() as cur:
-        cur.execute("UPDATE users SET role = 'admin' WHERE telegram_id = %s", (uid,))
+    await repo.set_role(uid, 'admin')
     await callback.message.answer("✅ Пользователь повышен до администратора.")
 
 @dp.callback_query(F.data.startswith("demote:"))
 async def demote_user(callback: types.CallbackQuery):
     uid = int(callback.data.split(":")[1])
-    with conn.cursor() as cur:
-        cur.execute("UPDATE users SET role = 'operator' WHERE telegram_id = %s", (uid,))
+    await repo.set_role(uid, 'operator')
     await callback.message.answer("🔻 Пользователь понижен до оператора.")
 
 async def main():
-    global conn
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        database=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD
-    )
-    conn.autocommit = True
-
-    with conn.cursor() as cur:
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id SERIAL PRIMARY KEY,
-            telegram_id BIGINT UNIQUE,
-            full_name TEXT,
-            username TEXT,
-            role TEXT,
-            registered_at TIMESTAMP DEFAULT NOW()
-        );
-        """)
-
-    await dp.start_polling(bot)
+    global repo
+    db = Database.from_env()
+    with db.connection() as conn:
+        check_schema(conn)
+    repo = Repository(db, cache_size=BOT_CACHE_SIZE, cache_ttl=BOT_CACHE_TTL)
+    repo.watch_series(db.connect)
+    metrics.serve(BOT_METRICS_PORT)
+
+    try:
+        await dp.start_polling(bot)
+    finally:
+        repo.close()
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,63 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class AsyncCache:
+    """LRU-кэш с TTL для результатов корутин, в пределах event loop бота.
+
+    get(key, load) возвращает свежее значение из кэша или вызывает load();
+    одновременные промахи по одному ключу ждут одной загрузки. invalidate()
+    отбрасывает подходящие записи, а результат загрузки, начатой до
+    инвалидации, в кэш уже не попадает. Размер ограничен size записями.
+    """
+
+    def __init__(self, size=1024, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._generation = 0
+
+    async def get(self, key, load):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            return entry[1]
+        future = self._inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = self._inflight[key] = asyncio.get_running_loop().create_future()
+        generation = self._generation
+        try:
+            value = await load()
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # ожидающих может не быть
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+        if generation == self._generation:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        future.set_result(value)
+        return value
+
+    def invalidate(self, match=None):
+        # match(key) -> bool; без него сбрасывается всё
+        self._generation += 1
+        if match is None:
+            self._entries.clear()
+            self._inflight.clear()
+            return
+        for key in [k for k in self._entries if match(k)]:
+            del self._entries[key]
+        for key in [k for k in self._inflight if match(k)]:
+            del self._inflight[key]
@@ -0,0 +1,56 @@
+import io
+import threading
+from collections import OrderedDict
+
+FIGSIZE = (8, 4)
+DPI = 100
+# По корзине даёт две точки (min и max), итого не больше точек, чем пикселей по ширине
+BUCKETS = FIGSIZE[0] * DPI // 2
+MARKER_MAX_POINTS = 200
+
+
+def render_plot(title, rows):
+    # rows: (timestamp, value) по возрастанию времени. Только объектный API
+    # matplotlib, без глобального состояния pyplot, поэтому безопасно в потоках.
+    # Импорт здесь: matplotlib грузится секунды и нужен только для графиков.
+    from matplotlib.figure import Figure
+
+    timestamps = [r[0] for r in rows]
+    values = [r[1] for r in rows]
+    fig = Figure(figsize=FIGSIZE, dpi=DPI)
+    ax = fig.subplots()
+    ax.plot(timestamps, values, marker="o" if len(rows) <= MARKER_MAX_POINTS else None)
+    ax.set_title(title)
+    ax.grid(True)
+    ax.tick_params(axis="x", labelrotation=45)
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png")
+    return buf.getvalue()
+
+
+class PlotCache:
+    """LRU готовых PNG по ключу (telegram_id, sensor, parameter, count, latest_ts).
+
+    Новое показание меняет latest_ts, так что устаревшие графики просто
+    перестают запрашиваться и вытесняются.
+    """
+
+    def __init__(self, size=128):
+        self.size = size
+        self._plots = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            png = self._plots.get(key)
+            if png is not None:
+                self._plots.move_to_end(key)
+            return png
+
+    def put(self, key, png):
+        with self._lock:
+            self._plots[key] = png
+            self._plots.move_to_end(key)
+            while len(self._plots) > self.size:
+                self._plots.popitem(last=False)
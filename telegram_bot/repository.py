@@ -0,0 +1,213 @@
+import asyncio
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+
+from core import export, rollups
+from core.db import listen
+from core.schema import SERIES_CHANNEL
+from cache import AsyncCache
+
+# Ключи кэша со списками пользователей — сбрасываются при любом изменении users
+USER_LISTS = ("users", "users_info", "users_with_role")
+
+
+class Repository:
+    """Доступ бота к БД, не блокирующий event loop.
+
+    Запросы выполняются в пуле потоков размером с пул соединений
+    core.db.Database, так что медленный запрос занимает один поток, а
+    polling и обработчики других пользователей продолжают работать.
+
+    Роли, списки пользователей и справочники датчиков/параметров, которые
+    перечитываются на каждом шаге меню, кэшируются (AsyncCache). Изменения
+    через бота сбрасывают кэш сразу, новые ряды — по NOTIFY из БД (см.
+    watch_series), всё прочее устаревает через cache_ttl секунд.
+    """
+
+    def __init__(self, db, cache_size=1024, cache_ttl=60):
+        self._db = db
+        self._executor = ThreadPoolExecutor(max_workers=db.maxconn, thread_name_prefix="db")
+        self._cache = AsyncCache(size=cache_size, ttl=cache_ttl)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._db.close()
+
+    async def _call(self, fn, *args):
+        # fn(cur, *args) в потоке пула, одной транзакцией
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._transaction, fn, args)
+
+    def _transaction(self, fn, args):
+        with self._db.connection() as conn, conn.cursor() as cur:
+            return fn(cur, *args)
+
+    async def _run(self, sql, params=(), fetch=None):
+        return await self._call(_execute, sql, params, fetch)
+
+    async def _column(self, sql, params):
+        return [row[0] for row in await self._run(sql, params, fetch="all")]
+
+    async def _cached(self, key, sql, params=(), fetch="all"):
+        return await self._cache.get(key, lambda: self._run(sql, params, fetch))
+
+    def _users_changed(self, telegram_id):
+        self._cache.invalidate(lambda key: key[0] in USER_LISTS or key == ("role", telegram_id))
+
+    def _series_added(self, telegram_id):
+        self._cache.invalidate(lambda key: key[0] in ("sensors", "parameters") and key[1] == telegram_id)
+
+    def watch_series(self, connect):
+        # Фоновый LISTEN на SERIES_CHANNEL; вызывать из event loop бота
+        loop = asyncio.get_running_loop()
+
+        def added(notifies):
+            for telegram_id in {int(n.payload) for n in notifies}:
+                loop.call_soon_threadsafe(self._series_added, telegram_id)
+
+        def reset():
+            loop.call_soon_threadsafe(self._cache.invalidate, lambda key: key[0] in ("sensors", "parameters"))
+
+        return listen(connect, [SERIES_CHANNEL], added, reset, name="Series listener")
+
+    # Пользователи
+
+    async def register_user(self, telegram_id, full_name, username):
+        # Возвращает роль; новый пользователь заводится оператором
+        added = await self._run("""
+            INSERT INTO users (telegram_id, full_name, username, role)
+            VALUES (%s, %s, %s, 'operator')
+            ON CONFLICT (telegram_id) DO NOTHING
+            RETURNING id
+        """, (telegram_id, full_name, username), fetch="one")
+        if added:
+            self._users_changed(telegram_id)
+        return await self.user_role(telegram_id)
+
+    async def user_role(self, telegram_id):
+        row = await self._cached(("role", telegram_id),
+                                 "SELECT role FROM users WHERE telegram_id = %s", (telegram_id,), fetch="one")
+        return row[0] if row else 'operator'
+
+    async def users(self):
+        return await self._cached(("users",), "SELECT telegram_id, username FROM users")
+
+    async def users_info(self):
+        return await self._cached(("users_info",), "SELECT full_name, username, role, registered_at FROM users")
+
+    async def users_with_role(self, role, exclude=None):
+        return await self._cached(
+            ("users_with_role", role, exclude),
+            "SELECT telegram_id, username FROM users WHERE role = %s AND telegram_id IS DISTINCT FROM %s",
+            (role, exclude))
+
+    async def set_role(self, telegram_id, role):
+        await self._run("UPDATE users SET role = %s WHERE telegram_id = %s", (role, telegram_id))
+        self._users_changed(telegram_id)
+
+    # Показания
+
+    async def sensors(self, telegram_id):
+        return await self._cache.get(("sensors", telegram_id), lambda: self._column(
+            "SELECT DISTINCT sensor FROM sensor_latest_ext WHERE telegram_id = %s ORDER BY sensor",
+            (telegram_id,)))
+
+    async def parameters(self, telegram_id, sensor):
+        return await self._cache.get(("parameters", telegram_id, sensor), lambda: self._column(
+            "SELECT DISTINCT parameter FROM sensor_latest_ext WHERE sensor = %s AND telegram_id = %s ORDER BY parameter",
+            (sensor, telegram_id)))
+
+    async def latest(self, telegram_id, sensor):
+        return await self._run("""
+            SELECT parameter, value, unit
+            FROM sensor_latest_ext
+            WHERE sensor = %s AND telegram_id = %s
+            ORDER BY parameter
+        """, (sensor, telegram_id), fetch="all")
+
+    async def latest_timestamp(self, telegram_id, sensor, parameter):
+        row = await self._run("""
+            SELECT timestamp FROM sensor_latest_ext
+            WHERE telegram_id = %s AND sensor = %s AND parameter = %s
+        """, (telegram_id, sensor, parameter), fetch="one")
+        return row[0] if row else None
+
+    async def history(self, telegram_id, sensor, parameter, count, buckets):
+        # Последние count показаний как (timestamp, value) по возрастанию
+        # времени, не больше двух точек (минимум и максимум) на корзину
+        return await self._call(_history, telegram_id, sensor, parameter, count, buckets)
+
+    async def export_csv(self, path, telegram_id, sensor, parameter, start, limit=None):
+        # Показания в файл path (CSV, gzip) серверным курсором; возвращает число
+        # строк или None, если сжатый файл вышел за limit байт (запись прерывается)
+        return await self._call(_export_csv, path, telegram_id, sensor, parameter, start, limit)
+
+    # Пороги
+
+    async def set_threshold(self, telegram_id, sensor, parameter, lower, upper):
+        await self._run("""
+            INSERT INTO parameter_thresholds (telegram_id, sensor, parameter, lower_bound, upper_bound)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (telegram_id, sensor, parameter)
+            DO UPDATE SET lower_bound = EXCLUDED.lower_bound, upper_bound = EXCLUDED.upper_bound
+        """, (telegram_id, sensor, parameter, lower, upper))
+
+
+def _execute(cur, sql, params, fetch):
+    cur.execute(sql, params)
+    if fetch == "one":
+        return cur.fetchone()
+    if fetch == "all":
+        return cur.fetchall()
+
+
+def _export_csv(cur, path, telegram_id, sensor, parameter, start, limit):
+    rows = export.open_export(cur.connection, telegram_id, sensor, parameter, start)
+    count = 0
+
+    def counted():
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    with open(path, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as f:
+        for chunk in export.csv_chunks(counted()):
+            f.write(chunk)
+            if limit is not None and raw.tell() > limit:
+                return None
+    return count
+
+
+def _history(cur, telegram_id, sensor, parameter, count, buckets):
+    # Длинные диапазоны читаются из самого грубого подходящего уровня
+    # sensor_rollups, короткие — из сырых показаний с прореживанием в БД
+    series_id = rollups.series_id(cur, telegram_id, sensor, parameter)
+    if series_id is None:
+        return []
+    if count > 2 * buckets:
+        cur.execute("SELECT timestamp FROM sensor_latest WHERE series_id = %s", (series_id,))
+        latest = cur.fetchone()
+        start = rollups.window_start(cur, series_id, count)
+        resolution = latest and latest[0] and start and rollups.pick_resolution(start, latest[0], buckets)
+        if resolution:
+            rows = []
+            for bucket, low, high in rollups.read_rollups(cur, series_id, resolution, start, latest[0], buckets):
+                rows += [(bucket, low), (bucket, high)]
+            return rows
+    cur.execute("""
+        WITH recent AS (
+            SELECT timestamp, value FROM sensor_readings
+            WHERE series_id = %s AND timestamp IS NOT NULL
+            ORDER BY timestamp DESC LIMIT %s
+        ), ranked AS (
+            SELECT timestamp, value, bucket,
+                   row_number() OVER (PARTITION BY bucket ORDER BY value ASC NULLS LAST, timestamp) AS lo,
+                   row_number() OVER (PARTITION BY bucket ORDER BY value DESC NULLS LAST, timestamp) AS hi
+            FROM (SELECT timestamp, value, ntile(%s) OVER (ORDER BY timestamp) AS bucket FROM recent) b
+        )
+        SELECT timestamp, value FROM ranked
+        WHERE lo = 1 OR hi = 1
+        ORDER BY timestamp
+    """, (series_id, count, buckets))
+    return cur.fetchall()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# core — пакет в корне, модули API импортируются как в api/app.py
+sys.path[:0] = [ROOT, os.path.join(ROOT, "api")]
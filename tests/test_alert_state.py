@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from core import alert_state
+from core.alert_state import FIRED, FIRING, OK, RESOLVED, AlertPolicy, evaluate
+
+KEY = (1, "bme280", "temperature")
+T0 = datetime(2026, 1, 1, 12, 0)
+NOW = datetime(2026, 1, 2)
+
+
+class FakeCursor:
+    # Отдаёт сохранённые строки alert_state на SELECT ... FOR UPDATE
+    def __init__(self, stored=()):
+        self.stored = list(stored)
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchall(self):
+        return self.stored
+
+
+@pytest.fixture
+def written(monkeypatch):
+    rows = []
+    monkeypatch.setattr(alert_state, "execute_values", lambda cur, sql, values: rows.extend(values))
+    return rows
+
+
+def readings(*breaches, step=timedelta(seconds=1)):
+    return [(T0 + i * step, breach, float(i), None) for i, breach in enumerate(breaches)]
+
+
+def kinds(events):
+    return [(key, event, value) for key, event, value, _ in events]
+
+
+def test_breach_in_the_middle_of_a_batch_fires_and_resolves(written):
+    observations = {KEY: readings(False, False, True, True, True, False, False)}
+    events = evaluate(FakeCursor(), "threshold", observations, AlertPolicy(cooldown=300), now=NOW)
+    assert kinds(events) == [(KEY, FIRED, 2.0), (KEY, RESOLVED, 5.0)]
+    assert written[0][4] == OK
+
+
+def test_breach_at_the_end_of_a_batch_stays_firing(written):
+    observations = {KEY: readings(False, True)}
+    events = evaluate(FakeCursor(), "threshold", observations, AlertPolicy(), now=NOW)
+    assert kinds(events) == [(KEY, FIRED, 1.0)]
+    assert written[0][4:7] == (FIRING, T0 + timedelta(seconds=1), True)
+
+
+def test_readings_are_evaluated_in_timestamp_order(written):
+    observations = {KEY: list(reversed(readings(False, True, False)))}
+    events = evaluate(FakeCursor(), "threshold", observations, AlertPolicy(), now=NOW)
+    assert kinds(events) == [(KEY, FIRED, 1.0), (KEY, RESOLVED, 2.0)]
+
+
+def test_min_duration_is_measured_by_reading_time(written):
+    # Час нарушения, присланный задним числом одной пачкой
+    observations = {KEY: readings(*[True] * 61, step=timedelta(minutes=1))}
+    events = evaluate(FakeCursor(), "threshold", observations, AlertPolicy(min_duration=600), now=NOW)
+    assert kinds(events) == [(KEY, FIRED, 10.0)]
+
+
+def test_breach_shorter_than_min_duration_is_not_reported(written):
+    observations = {KEY: readings(True, True, False, step=timedelta(minutes=1))}
+    events = evaluate(FakeCursor(), "threshold", observations, AlertPolicy(min_duration=600), now=NOW)
+    assert events == []
+    assert written[0][4] == OK
+
+
+def test_cooldown_suppresses_repeated_episodes(written):
+    observations = {KEY: readings(True, False, True, False)}
+    events = evaluate(FakeCursor(), "threshold", observations, AlertPolicy(cooldown=300), now=NOW)
+    assert kinds(events) == [(KEY, FIRED, 0.0), (KEY, RESOLVED, 1.0)]
+
+
+def test_suppressed_firing_is_reported_once_cooldown_passes(written):
+    # Эпизод начался через минуту после прошлого сообщения: пока пауза не
+    # истекла, молчим, потом сообщаем о продолжающемся нарушении
+    stored = [(*KEY, OK, None, False, 0.0, NOW - timedelta(minutes=1))]
+    events = evaluate(FakeCursor(stored), "threshold", {KEY: readings(True)}, AlertPolicy(cooldown=300), now=NOW)
+    assert events == []
+    assert written[-1][4:7] == (FIRING, T0, False)
+
+    stored = [(*KEY, FIRING, T0, False, 0.0, NOW - timedelta(minutes=1))]
+    later = NOW + timedelta(minutes=5)
+    events = evaluate(FakeCursor(stored), "threshold", {KEY: readings(True, False)}, AlertPolicy(cooldown=300),
+                      now=later)
+    assert kinds(events) == [(KEY, FIRED, 0.0), (KEY, RESOLVED, 1.0)]
+
+
+def test_stored_firing_state_is_resolved(written):
+    stored = [(*KEY, FIRING, T0, True, 100.0, NOW - timedelta(minutes=1))]
+    observations = {KEY: readings(False)}
+    events = evaluate(FakeCursor(stored), "threshold", observations, AlertPolicy(), now=NOW)
+    assert kinds(events) == [(KEY, RESOLVED, 0.0)]
+
+
+def test_normal_readings_of_a_quiet_series_are_not_written(written):
+    observations = {KEY: readings(False, False)}
+    assert evaluate(FakeCursor(), "threshold", observations, AlertPolicy(), now=NOW) == []
+    assert written == []
@@ -0,0 +1,31 @@
+import numpy as np
+
+from thresholds import decisive_readings
+
+
+def bounds(n, lower=0.0, upper=50.0):
+    return np.full(n, lower), np.full(n, upper)
+
+
+def test_breach_in_the_middle_is_decisive():
+    values = np.array([10.0, 500.0, 500.0, 10.0])
+    idx, breach = decisive_readings(values, *bounds(4), hysteresis=0.0)
+    assert idx.tolist() == [0, 1, 2, 3]
+    assert breach.tolist() == [False, True, True, False]
+
+
+def test_readings_inside_the_hysteresis_margin_are_skipped():
+    # Полоса 0..50, гистерезис 10% — норма только внутри 5..45
+    values = np.array([60.0, 48.0, 2.0, 20.0])
+    idx, breach = decisive_readings(values, *bounds(4), hysteresis=0.1)
+    assert idx.tolist() == [0, 3]
+    assert breach.tolist() == [True, False]
+
+
+def test_missing_values_and_bounds_are_not_decisive():
+    values = np.array([np.nan, 500.0, 500.0])
+    lower = np.array([0.0, np.nan, np.nan])
+    upper = np.array([50.0, np.nan, 100.0])
+    idx, breach = decisive_readings(values, lower, upper, hysteresis=0.0)
+    assert idx.tolist() == [2]
+    assert breach.tolist() == [True]